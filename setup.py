@@ -34,12 +34,11 @@ setup(
         "scikit-learn",
         "jupyter",
         "jsonschema",
-        "multiprocess",
         "scipy",
         "matplotlib"
     ],
     extras_require={
-        "dev": ["wheel","dvc", "sphinx","sphinxcontrib-bibtex","sphinxcontrib-napoleon"],
+        "dev": ["wheel","dvc", "pytest", "sphinx","sphinxcontrib-bibtex","sphinxcontrib-napoleon"],
     },
 
 )
@@ -1,8 +1,34 @@
 import time
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from fuzzy_sql.randomquery import RandomQuery
 
 
-def gen_aggfltr_queries(n_queries: int, db_path: str, real_tbl_lst: list, metadata_lst: list,  syn_tbl_lst: list, max_query_time=5) -> list:
+def iter_aggfltr_queries(n_queries: int, db_path: str, real_tbl_lst: list, metadata_lst: list,  syn_tbl_lst: list, max_query_time=5, query_obj: RandomQuery = None, metrics_only=False, n_workers=1, seed=None):
+    ''' The generator yields multiple twin random queries of aggregate-filter type one at a time, as soon as each query is scored. Unlike gen_aggfltr_queries, the generated queries are not kept in memory by the generator. 
+
+    Args:
+        n_queries: The required number of queries to be generated.
+        db_path: Database full path as string.
+        real_tbl_lst: A list of real table names (strings) to be used for generating the random queries. The list may include related tables.
+        metadata_list: A list of dictionaries describing the variables and relations for each input table. A single metadata dictionaries is used for each real table and its counterpart synthetic table since both real and synthetic tables shall have identical variables and relations.
+        syn_tbl_lst: A list of synthetic table names (strings) to be used for generating the random queries.
+        max_query_time: The maximum time in seconds that is allowed to execute a randomly generated query expression before it skips it to the next random expression. 
+        query_obj: An optional RandomQuery object that was already constructed for the same database, real tables and metadata. Pass it to reuse its loaded tables and value bags across several calls. The default None will construct a single RandomQuery object that is reused for all the generated queries. When n_workers is larger than 1, each worker constructs its own object with the same construction options (e.g. val_bag_mode) and public attributes (e.g. oprtns) of query_obj.
+        metrics_only: If set to True, the query results (i.e. the real and synthetic dataframes) are dropped from each yielded dictionary and only the query description (including the SQL statements) and the scores are kept. 
+        n_workers: The number of worker processes used to compile, execute, match and score the queries in parallel. Each worker opens its own read-only connections to the database. The default of 1 generates all the queries in the current process.
+        seed: An optional master seed (integer). If provided, the random state of each query is derived from the master seed and the query number, so that the same set of queries is generated regardless of n_workers. The default None does not fix the random state, unless fix_seed is set for query_obj where its fixed seed is used as the master seed.
+
+    Yields: 
+        A dictionary that includes the query result for real data as a dataframe, the query result for synthetic data as a dataframe, a dictionary describing the query details, a float representing the twin query Hellinger distance and another representing  Euclidean distance, whenever applicable.  
+    '''
+       
+    for k, (scored_query, elapsed) in enumerate(_iter_scored_queries('aggfltr', n_queries, db_path, real_tbl_lst, metadata_lst, syn_tbl_lst, max_query_time, query_obj, metrics_only, n_workers, seed)):
+        print('Generated Random Aggregate Filter Query - {} in {:0.1f} seconds.'.format(str(k+1), elapsed))
+        yield scored_query
+
+
+def gen_aggfltr_queries(n_queries: int, db_path: str, real_tbl_lst: list, metadata_lst: list,  syn_tbl_lst: list, max_query_time=5, query_obj: RandomQuery = None, metrics_only=False, n_workers=1, seed=None) -> list:
     ''' The function generates multiple twin random queries of aggregate-filter type. 
 
     Args:
@@ -12,33 +38,44 @@ def gen_aggfltr_queries(n_queries: int, db_path: str, real_tbl_lst: list, metada
         metadata_list: A list of dictionaries describing the variables and relations for each input table. A single metadata dictionaries is used for each real table and its counterpart synthetic table since both real and synthetic tables shall have identical variables and relations.
         syn_tbl_lst: A list of synthetic table names (strings) to be used for generating the random queries.
         max_query_time: The maximum time in seconds that is allowed to execute a randomly generated query expression before it skips it to the next random expression. 
+        query_obj: An optional RandomQuery object that was already constructed for the same database, real tables and metadata. Pass it to reuse its loaded tables and value bags across several calls. The default None will construct a single RandomQuery object that is reused for all the generated queries. When n_workers is larger than 1, each worker constructs its own object with the same construction options (e.g. val_bag_mode) and public attributes (e.g. oprtns) of query_obj.
+        metrics_only: If set to True, the query results (i.e. the real and synthetic dataframes) are dropped from each dictionary and only the query description (including the SQL statements) and the scores are kept. 
+        n_workers: The number of worker processes used to compile, execute, match and score the queries in parallel. Each worker opens its own read-only connections to the database. The default of 1 generates all the queries in the current process.
+        seed: An optional master seed (integer). If provided, the random state of each query is derived from the master seed and the query number, so that the same set of queries is generated regardless of n_workers. The default None does not fix the random state, unless fix_seed is set for query_obj where its fixed seed is used as the master seed.
 
     Returns: 
         A list of dictionaries where each dictionary includes the query result for real data as a dataframe, the query result for synthetic data as a dataframe, a dictionary describing the query details, a float representing the twin query Hellinger distance and another representing  Euclidean distance, whenever applicable.  
     '''
+
+    return list(iter_aggfltr_queries(n_queries, db_path, real_tbl_lst, metadata_lst, syn_tbl_lst, max_query_time, query_obj, metrics_only, n_workers, seed))
+
+
+def iter_fltr_queries(n_queries: int, db_path: str, real_tbl_lst: list, metadata_lst: list,  syn_tbl_lst: list, max_query_time=5, query_obj: RandomQuery = None, metrics_only=False, n_workers=1, seed=None):
+    ''' The generator yields multiple twin random queries of filter type one at a time, as soon as each query is scored. Unlike gen_fltr_queries, the generated queries are not kept in memory by the generator. 
+
+    Args:
+        n_queries: The required number of queries to be generated.
+        db_path: Database full path as string.
+        real_tbl_lst: A list of real table names (strings) to be used for generating the random queries. The list may include related tables.
+        metadata_list: A list of dictionaries describing the variables and relations for each input table. A single metadata dictionaries is used for each real table and its counterpart synthetic table since both real and synthetic tables shall have identical variables and relations.
+        syn_tbl_lst: A list of synthetic table names (strings) to be used for generating the random queries.
+        max_query_time: The maximum time in seconds that is allowed to execute a randomly generated query expression before it skips it to the next random expression. 
+        query_obj: An optional RandomQuery object that was already constructed for the same database, real tables and metadata. Pass it to reuse its loaded tables and value bags across several calls. The default None will construct a single RandomQuery object that is reused for all the generated queries. When n_workers is larger than 1, each worker constructs its own object with the same construction options (e.g. val_bag_mode) and public attributes (e.g. oprtns) of query_obj.
+        metrics_only: If set to True, the query results (i.e. the real and synthetic dataframes) are dropped from each yielded dictionary and only the query description (including the SQL statements) and the scores are kept. 
+        n_workers: The number of worker processes used to compile, execute, match and score the queries in parallel. Each worker opens its own read-only connections to the database. The default of 1 generates all the queries in the current process.
+        seed: An optional master seed (integer). If provided, the random state of each query is derived from the master seed and the query number, so that the same set of queries is generated regardless of n_workers. The default None does not fix the random state, unless fix_seed is set for query_obj where its fixed seed is used as the master seed.
+
+    Yields: 
+        A dictionary that includes the query result for real data as a dataframe, the query result for synthetic data as a dataframe, a dictionary describing the query details, the median, IQR and standard deviation of the Hellinger distances of the query variables and a dataframe of the Hellinger distance of each variable.  
+    '''
        
-    queries = []
-    k = 0
-    while k < n_queries:
-        start=time.time()
-        query_obj = RandomQuery(db_path, real_tbl_lst, metadata_lst)
-        real_expr, real_groupby_lst, real_from_tbl, real_join_tbl_lst, agg_fntn_terms = query_obj.compile_aggfltr_expr()
-        
-        if not query_obj._test_query_time(db_path,real_expr):
-            continue
-        
-        rnd_query = query_obj.make_twin_aggfltr_query(syn_tbl_lst, real_expr, real_groupby_lst, real_from_tbl, real_join_tbl_lst, agg_fntn_terms)
-        matched_query = query_obj._match_queries4agg(rnd_query)
-        scored_query = query_obj.gather_metrics4agg(matched_query)
-        queries.append(scored_query)
-        k += 1
-        end=time.time()
-        print('Generated Random Aggregate Filter Query - {} in {:0.1f} seconds.'.format(str(k), end-start))
-    
-    return queries
+    for k, (scored_query, elapsed) in enumerate(_iter_scored_queries('fltr', n_queries, db_path, real_tbl_lst, metadata_lst, syn_tbl_lst, max_query_time, query_obj, metrics_only, n_workers, seed)):
+        print('Generated Random Filter Query - {} in {:0.1f} seconds.'.format(str(k+1), elapsed))
+        print('\n')
+        yield scored_query
 
 
-def gen_fltr_queries(n_queries: int, db_path: str, real_tbl_lst: list, metadata_lst: list,  syn_tbl_lst: list, max_query_time=5) -> list:
+def gen_fltr_queries(n_queries: int, db_path: str, real_tbl_lst: list, metadata_lst: list,  syn_tbl_lst: list, max_query_time=5, query_obj: RandomQuery = None, metrics_only=False, n_workers=1, seed=None) -> list:
     ''' The function generates multiple twin random queries of filter type. 
 
     Args:
@@ -48,31 +85,177 @@ def gen_fltr_queries(n_queries: int, db_path: str, real_tbl_lst: list, metadata_
         metadata_list: A list of dictionaries describing the variables and relations for each input table. A single metadata dictionaries is used for each real table and its counterpart synthetic table since both real and synthetic tables shall have identical variables and relations.
         syn_tbl_lst: A list of synthetic table names (strings) to be used for generating the random queries.
         max_query_time: The maximum time in seconds that is allowed to execute a randomly generated query expression before it skips it to the next random expression. 
+        query_obj: An optional RandomQuery object that was already constructed for the same database, real tables and metadata. Pass it to reuse its loaded tables and value bags across several calls. The default None will construct a single RandomQuery object that is reused for all the generated queries. When n_workers is larger than 1, each worker constructs its own object with the same construction options (e.g. val_bag_mode) and public attributes (e.g. oprtns) of query_obj.
+        metrics_only: If set to True, the query results (i.e. the real and synthetic dataframes) are dropped from each dictionary and only the query description (including the SQL statements) and the scores are kept. 
+        n_workers: The number of worker processes used to compile, execute, match and score the queries in parallel. Each worker opens its own read-only connections to the database. The default of 1 generates all the queries in the current process.
+        seed: An optional master seed (integer). If provided, the random state of each query is derived from the master seed and the query number, so that the same set of queries is generated regardless of n_workers. The default None does not fix the random state, unless fix_seed is set for query_obj where its fixed seed is used as the master seed.
 
     Returns: 
         A list of dictionaries where each dictionary includes the query result for real data as a dataframe, the query result for synthetic data as a dataframe, a dictionary describing the query details, a float representing the twin query Hellinger distance and another representing  Euclidean distance, whenever applicable.  
     '''
-       
-    queries = []
-    k = 0
-    while k < n_queries:
-        start=time.time()
-        query_obj = RandomQuery(db_path, real_tbl_lst, metadata_lst)
-        real_expr, real_from_tbl, real_join_tbl_lst = query_obj.compile_fltr_expr()
-        
-        if not query_obj._test_query_time(db_path,real_expr):
+
+    return list(iter_fltr_queries(n_queries, db_path, real_tbl_lst, metadata_lst, syn_tbl_lst, max_query_time, query_obj, metrics_only, n_workers, seed))
+
+
+def gen_aggfltr_score_matrix(n_queries: int, db_path: str, real_tbl_lst: list, metadata_lst: list,  syn_tbl_lsts: list, max_query_time=5, query_obj: RandomQuery = None, n_workers=1, seed=None) -> pd.DataFrame:
+    ''' The function scores multiple synthetic candidates against one set of random aggregate-filter queries. Each query is compiled and executed against the real tables only once, and then executed against the synthetic tables of every candidate, so that all the candidates are scored on the same queries. 
+
+    Args:
+        n_queries: The required number of queries to be generated.
+        db_path: Database full path as string.
+        real_tbl_lst: A list of real table names (strings) to be used for generating the random queries. The list may include related tables.
+        metadata_list: A list of dictionaries describing the variables and relations for each input table. A single metadata dictionaries is used for each real table and its counterpart synthetic tables since both real and synthetic tables shall have identical variables and relations.
+        syn_tbl_lsts: A list of synthetic candidates, where each candidate is a list of synthetic table names (strings) in the order of real_tbl_lst.
+        max_query_time: The maximum time in seconds that is allowed to execute a randomly generated query expression (against the real tables or any candidate) before it skips it to the next random expression. 
+        query_obj: An optional RandomQuery object that was already constructed for the same database, real tables and metadata. See gen_aggfltr_queries.
+        n_workers: The number of worker processes used to generate and score the queries in parallel. See gen_aggfltr_queries.
+        seed: An optional master seed (integer). See gen_aggfltr_queries.
+
+    Returns: 
+        A dataframe of the Hellinger distances of the twin queries, with a row for each query (indexed by its real SQL statement) and a column for each candidate (labeled by its comma-separated synthetic table names).  
+    '''
+
+    return _make_score_matrix('aggfltr', n_queries, db_path, real_tbl_lst, metadata_lst, syn_tbl_lsts, max_query_time, query_obj, n_workers, seed)
+
+
+def gen_fltr_score_matrix(n_queries: int, db_path: str, real_tbl_lst: list, metadata_lst: list,  syn_tbl_lsts: list, max_query_time=5, query_obj: RandomQuery = None, n_workers=1, seed=None) -> pd.DataFrame:
+    ''' The function scores multiple synthetic candidates against one set of random filter queries. Each query is compiled and executed against the real tables only once, and then executed against the synthetic tables of every candidate, so that all the candidates are scored on the same queries. 
+
+    Args:
+        n_queries: The required number of queries to be generated.
+        db_path: Database full path as string.
+        real_tbl_lst: A list of real table names (strings) to be used for generating the random queries. The list may include related tables.
+        metadata_list: A list of dictionaries describing the variables and relations for each input table. A single metadata dictionaries is used for each real table and its counterpart synthetic tables since both real and synthetic tables shall have identical variables and relations.
+        syn_tbl_lsts: A list of synthetic candidates, where each candidate is a list of synthetic table names (strings) in the order of real_tbl_lst.
+        max_query_time: The maximum time in seconds that is allowed to execute a randomly generated query expression (against the real tables or any candidate) before it skips it to the next random expression. 
+        query_obj: An optional RandomQuery object that was already constructed for the same database, real tables and metadata. See gen_aggfltr_queries.
+        n_workers: The number of worker processes used to generate and score the queries in parallel. See gen_aggfltr_queries.
+        seed: An optional master seed (integer). See gen_aggfltr_queries.
+
+    Returns: 
+        A dataframe of the median Hellinger distances of the variables of the twin queries, with a row for each query (indexed by its real SQL statement) and a column for each candidate (labeled by its comma-separated synthetic table names).  
+    '''
+
+    return _make_score_matrix('fltr', n_queries, db_path, real_tbl_lst, metadata_lst, syn_tbl_lsts, max_query_time, query_obj, n_workers, seed)
+
+
+def _make_score_matrix(query_type: str, n_queries: int, db_path: str, real_tbl_lst: list, metadata_lst: list,  syn_tbl_lsts: list, max_query_time, query_obj: RandomQuery, n_workers: int, seed) -> pd.DataFrame:
+    # Collects the candidate scores of the multi-candidate queries into a dataframe of queries x candidates
+    sql_lst, score_lst = [], []
+    for k, (scored_query, elapsed) in enumerate(_iter_scored_queries(query_type+'_multi', n_queries, db_path, real_tbl_lst, metadata_lst, syn_tbl_lsts, max_query_time, query_obj, True, n_workers, seed)):
+        print('Scored Random Query - {} against {} candidates in {:0.1f} seconds.'.format(str(k+1), len(syn_tbl_lsts), elapsed))
+        sql_lst.append(scored_query['sql_real'])
+        score_lst.append(scored_query['scores'])
+    candidates = [', '.join(syn_tbl_lst) for syn_tbl_lst in syn_tbl_lsts]
+    return pd.DataFrame(score_lst, index=pd.Index(sql_lst, name='sql_real'), columns=pd.Index(candidates, name='candidate'))
+
+
+def _iter_scored_queries(query_type: str, n_queries: int, db_path: str, real_tbl_lst: list, metadata_lst: list,  syn_tbl_lst: list, max_query_time, query_obj: RandomQuery, metrics_only: bool, n_workers: int, seed):
+    # Yields tuples of (scored query, generation time in seconds) in the order of the query number whether the queries are generated serially or by a pool of workers
+    if seed is None and query_obj is not None and query_obj.fix_seed:  # each query takes its own stream of the fixed seed, so that the workers do not replay the same stream
+        seed = query_obj._seed_no
+    if n_workers <= 1:
+        own_query_obj = query_obj is None
+        if own_query_obj:
+            query_obj = RandomQuery(db_path, real_tbl_lst, metadata_lst)
+        try:
+            for query_no in range(n_queries):
+                yield _make_scored_query(query_obj, query_type, syn_tbl_lst, max_query_time, metrics_only, seed, query_no)
+        finally:
+            if own_query_obj:
+                query_obj.close()
+        return
+
+    init_kwargs = {} if query_obj is None else query_obj._init_kwargs
+    obj_attrs = {} if query_obj is None else {key: val for key, val in vars(query_obj).items() if not key.startswith('_')}
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(db_path, real_tbl_lst, metadata_lst, init_kwargs, obj_attrs)) as executor:
+        # Keep a bounded number of submitted queries ahead of the consumer so that the results do not pile up in memory
+        futures = []
+        for query_no in range(n_queries):
+            futures.append(executor.submit(_make_worker_scored_query, query_type, syn_tbl_lst, max_query_time, metrics_only, seed, query_no))
+            if len(futures) >= 2*n_workers:
+                yield futures.pop(0).result()
+        for future in futures:
+            yield future.result()
+
+
+def _make_scored_query(query_obj: RandomQuery, query_type: str, syn_tbl_lst: list, max_query_time, metrics_only: bool, seed=None, query_no: int = None) -> tuple:
+    # Compiles, executes, matches and scores a single twin query while skipping any expression that takes too long to execute
+    start=time.time()
+    if seed is not None:
+        query_obj.reseed(seed, query_no)  # the random stream of the query number is independent of the other queries
+    if query_type.endswith('_multi'):
+        scored_query = _make_multi_scored_query(query_obj, query_type[:-len('_multi')], syn_tbl_lst, max_query_time)
+        return scored_query, time.time()-start
+    while True:
+        try:
+            if query_type == 'aggfltr':
+                real_expr, real_groupby_lst, real_from_tbl, real_join_tbl_lst, agg_fntn_terms = query_obj.compile_aggfltr_expr()
+                rnd_query = query_obj.make_twin_aggfltr_query(syn_tbl_lst, real_expr, real_groupby_lst, real_from_tbl, real_join_tbl_lst, agg_fntn_terms, max_query_time)
+                matched_query = query_obj._match_queries4agg(rnd_query)
+                scored_query = query_obj.gather_metrics4agg(matched_query)
+            elif query_type == 'fltr':
+                real_expr, real_from_tbl, real_join_tbl_lst = query_obj.compile_fltr_expr()
+                rnd_query = query_obj.make_twin_fltr_query(syn_tbl_lst, real_expr, real_from_tbl, real_join_tbl_lst, max_query_time)
+                scored_query=query_obj.gather_metrics4fltr(rnd_query)
+            else:
+                raise ValueError(f'Unrecognized query type: {query_type}')
+        except TimeoutError:
+            print('Cant wait any further! I am skipping this one!')
             continue
-        
-        rnd_query = query_obj.make_twin_fltr_query(syn_tbl_lst, real_expr, real_from_tbl, real_join_tbl_lst)
-        scored_query=query_obj.gather_metrics4fltr(rnd_query)
-        queries.append(scored_query)
-        
-        k += 1
-        end=time.time()
-        print('Generated Random Filter Query - {} in {:0.1f} seconds.'.format(str(k), end-start))
-        print('\n')
-    
-    return queries
+        break
+    if metrics_only:
+        _drop_query_results(scored_query)
+    end=time.time()
+    return scored_query, end-start
+
+
+def _make_multi_scored_query(query_obj: RandomQuery, query_type: str, syn_tbl_lsts: list, max_query_time) -> dict:
+    # Compiles a single query and scores it against each synthetic candidate in syn_tbl_lsts, where the real side is executed only once. The expression is skipped if it takes too long to execute against the real tables or any candidate, so that all the candidates are scored on the same queries.
+    while True:
+        try:
+            real_twin = None
+            scores = []
+            if query_type == 'aggfltr':
+                real_expr, real_groupby_lst, real_from_tbl, real_join_tbl_lst, agg_fntn_terms = query_obj.compile_aggfltr_expr()
+                for syn_tbl_lst in syn_tbl_lsts:
+                    rnd_query = query_obj.make_twin_aggfltr_query(syn_tbl_lst, real_expr, real_groupby_lst, real_from_tbl, real_join_tbl_lst, agg_fntn_terms, max_query_time, real_twin)
+                    real_twin = rnd_query if real_twin is None else real_twin
+                    scores.append(query_obj.gather_metrics4agg(query_obj._match_queries4agg(rnd_query))['query_hlngr_score'])
+            elif query_type == 'fltr':
+                real_expr, real_from_tbl, real_join_tbl_lst = query_obj.compile_fltr_expr()
+                for syn_tbl_lst in syn_tbl_lsts:
+                    rnd_query = query_obj.make_twin_fltr_query(syn_tbl_lst, real_expr, real_from_tbl, real_join_tbl_lst, max_query_time, real_twin)
+                    real_twin = rnd_query if real_twin is None else real_twin
+                    scores.append(query_obj.gather_metrics4fltr(rnd_query)['hlngr_median'])
+            else:
+                raise ValueError(f'Unrecognized query type: {query_type}')
+        except TimeoutError:
+            print('Cant wait any further! I am skipping this one!')
+            continue
+        break
+    return {'sql_real': real_expr, 'scores': scores}
+
+
+_worker_query_obj = None  # The RandomQuery object of the current worker process
+
+
+def _init_worker(db_path: str, real_tbl_lst: list, metadata_lst: list, init_kwargs: dict, obj_attrs: dict):
+    # Constructs a single RandomQuery object per worker process with the same construction options and public attributes of the caller's object, if any
+    global _worker_query_obj
+    _worker_query_obj = RandomQuery(db_path, real_tbl_lst, metadata_lst, **init_kwargs)
+    for key, val in obj_attrs.items():
+        setattr(_worker_query_obj, key, val)
+
+
+def _make_worker_scored_query(query_type: str, syn_tbl_lst: list, max_query_time, metrics_only: bool, seed, query_no: int) -> tuple:
+    return _make_scored_query(_worker_query_obj, query_type, syn_tbl_lst, max_query_time, metrics_only, seed, query_no)
+
+
+def _drop_query_results(scored_query: dict):
+    # Drops the real and synthetic query results (dataframes) from the input scored query while keeping its description and scores
+    scored_query.pop('query_real', None)
+    scored_query.pop('query_syn', None)
 
 
 def calc_tabular_hlngr(db_path: str,  real_table_name:str, metadata: dict, syn_table_name: str):
@@ -90,5 +273,6 @@ def calc_tabular_hlngr(db_path: str,  real_table_name:str, metadata: dict, syn_t
 
     query_obj = RandomQuery(db_path, [real_table_name], [metadata])
     result=query_obj.gather_metrics4tabular(real_table_name,syn_table_name)
+    query_obj.close()
 
     return result
\ No newline at end of file
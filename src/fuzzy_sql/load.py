@@ -1,7 +1,13 @@
 import os
+import time
+import sqlite3
 import pandas as pd
 import json
+import multiprocessing
 from pathlib import Path
+from queue import Empty
+from concurrent.futures import ProcessPoolExecutor
+from fuzzy_sql.randomquery import RandomQuery, CNT_VAR_TYPES, CAT_VAR_TYPES, DT_VAR_TYPES, IGN_VAR_TYPES
 
 
 
@@ -119,7 +125,7 @@ def get_vars_to_index(metadata: dict,data: pd.DataFrame, index_vars_types='all',
 
 
 
-def make_table(table_name: str, df: pd.DataFrame, db_conn: object, indx_vars=[]):
+def make_table(table_name: str, df: pd.DataFrame, db_conn: object, indx_vars=[], metadata: dict = None):
     """Imports the input dataframe into a database table. All dots in the variable names will be replaced by underscores.
 
     Args:
@@ -127,6 +133,7 @@ def make_table(table_name: str, df: pd.DataFrame, db_conn: object, indx_vars=[])
         df: The input data
         db_conn: Database (sqlite3) connection object
         indx_vars: A list of all the variables that need to be indexed in the database. A default value of empty list will result in unindexed table. 
+        metadata: The optional metadata dictionary of the table. If provided, the table columns are typed as per the variable types: continuous variables are stored in REAL columns, so that they are compared and aggregated as numbers, and dates are normalized into ISO 8601 strings (e.g. '2020-01-31' or '2020-01-31 13:45:00'), so that they are compared in chronological order. The default None creates the columns as per the data types of the dataframe.
     """
 
     # # replace any dot in the column names by underscore
@@ -141,10 +148,395 @@ def make_table(table_name: str, df: pd.DataFrame, db_conn: object, indx_vars=[])
                 (table_name,))  # sqlite_master holds  the schema of the db including table names
     # If table does not exist (ie returned count is zero), then import the table into db from pandas
     if cur.fetchone()[0] == 0: #if table does not exist
-        df.to_sql(table_name, db_conn, index=False)
+        if metadata is None:
+            df.to_sql(table_name, db_conn, index=False)
+        else:
+            var_types = {var_tpl[0]: var_tpl[1] for var_tpl in metadata['table_vars']}
+            cur.execute(_get_create_table_expr(table_name, list(df.columns), var_types))
+            _to_typed_df(df, var_types).to_sql(table_name, db_conn, index=False, if_exists='append')  # the values are converted by the affinity of the typed columns
         print(f'Table {table_name} is created in the database')
         for var in indx_vars:
             cur.execute(f"CREATE INDEX IDX_{table_name}_{var} ON {table_name}({var})")
             print(f'.... The index: IDX_{table_name}_{var} is created for the table: {table_name} in the database')
     else:
         print(f'Table {table_name} already exists in the database')
+
+
+
+
+def import_csv(csv_table_path: Path, db_conn: object, metadata: dict = None, optional_table_name='None', indx_vars=[], chunksize=100000, nrows=None) -> int:
+    """Streams the input csv file into a new database table in chunks, so that the file never has to fit in memory. It applies the same cleaning of prep_data_for_db (i.e. apostrophes are deleted from the values and dots in the variable names are replaced by underscores), but the table columns are typed as per the metadata like make_table does: continuous variables are stored in REAL columns, dates are normalized into ISO 8601 strings and all other variables are stored as TEXT. 
+    All the chunks are inserted in a single transaction with relaxed journaling and synchronization, so a failed import leaves no partial table behind. The indexes are built after all the data is inserted.
+
+    Args:
+        csv_table_path: The input file full path including the file name and csv extension.
+        db_conn: Database (sqlite3) connection object
+        metadata: The metadata dictionary of the table, which provides the types of the variables. The default None stores all the variables as TEXT like make_table does.
+        optional_table_name: This is an optional name of the table when imported into the database. The default 'None' will use the csv file name (without extension) as the table's name.
+        indx_vars: A list of all the variables that need to be indexed in the database. A default value of empty list will result in unindexed table. 
+        chunksize: The number of rows read from the csv file and inserted at a time.
+        nrows: The number of rows to be read from the input csv file. The default of None will read all the rows in the csv file.
+
+    Returns:
+        The number of imported rows.
+    """
+
+    if optional_table_name == 'None':
+        tbl_name = os.path.splitext(os.path.basename(csv_table_path))[0]
+    else:
+        tbl_name = optional_table_name
+    cur = db_conn.cursor()
+    cur.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name=(?) ", (tbl_name,))
+    if cur.fetchone()[0] != 0:
+        print(f'Table {tbl_name} already exists in the database')
+        return 0
+
+    var_types = {} if metadata is None else {var_tpl[0]: var_tpl[1] for var_tpl in metadata['table_vars']}
+    start = time.time()
+    chunks = ((tbl_name, _clean_csv_chunk(df, var_types)) for df in pd.read_csv(csv_table_path, encoding='unicode-escape', dtype=str, nrows=nrows, chunksize=chunksize))
+    n_rows = _write_chunks(db_conn, chunks, {tbl_name: var_types})[tbl_name]
+    elapsed = time.time()-start
+    print(f'Table {tbl_name} is created in the database with {n_rows} rows ({n_rows/max(elapsed, 1e-9):.0f} rows per second)')
+    for var in indx_vars:
+        cur.execute(f"CREATE INDEX IDX_{tbl_name}_{var} ON {tbl_name}({var})")
+        print(f'.... The index: IDX_{tbl_name}_{var} is created for the table: {tbl_name} in the database')
+    db_conn.commit()
+    return n_rows
+
+
+def import_csv_dir(csv_dir: Path, db_conn: object, metadata_lst: list = [], indx_vars_dict: dict = {}, n_workers=None, queue_size=8, chunksize=100000) -> dict:
+    """Imports all the csv files in the input directory (e.g. the linked tables of a real or synthetic longitudinal dataset, or both) into database tables. The files are read, cleaned and typed as per their metadata (see import_csv) by a pool of worker processes, one file at a time per worker, while the database is written by the input connection only. The workers hand over their chunks to the writer through a bounded queue, so that the memory in use stays within about queue_size chunks no matter how large the files are.
+    All the tables are inserted in a single transaction, so a failed import leaves none of them behind. The indexes are built after all the data is inserted. Files whose tables already exist in the database are skipped.
+
+    Args:
+        csv_dir: The directory of the csv files. The file names (without extension) are used as table names.
+        db_conn: Database (sqlite3) connection object
+        metadata_lst: A list of the metadata dictionaries of the tables, which are matched to the files by their table_name. The variables of the files without metadata are stored as TEXT.
+        indx_vars_dict: A dictionary of the variables to be indexed (list) of each table name.
+        n_workers: The number of worker processes reading the files. The default None uses as many workers as the processors of the machine (or the files, if fewer).
+        queue_size: The maximum number of chunks waiting in the queue for the writer.
+        chunksize: The number of rows read from a csv file and inserted at a time.
+
+    Returns:
+        A dictionary of the number of imported rows of each table.
+    """
+
+    csv_paths = sorted(Path(csv_dir).glob('*.csv'))
+    assert len(csv_paths) != 0, f"No csv files are found in {csv_dir}"
+    metadata_dict = {metadata['table_name']: metadata for metadata in metadata_lst}
+    var_types_dict = {}
+    cur = db_conn.cursor()
+    for csv_path in csv_paths:
+        tbl_name = csv_path.stem
+        cur.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name=(?) ", (tbl_name,))
+        if cur.fetchone()[0] != 0:
+            print(f'Table {tbl_name} already exists in the database')
+            continue
+        var_types_dict[tbl_name] = {var_tpl[0]: var_tpl[1] for var_tpl in metadata_dict[tbl_name]['table_vars']} if tbl_name in metadata_dict else {}
+    if len(var_types_dict) == 0:
+        return {}
+
+    start = time.time()
+    n_workers = min(n_workers or os.cpu_count(), len(var_types_dict))
+    mp_context = multiprocessing.get_context()
+    queue = mp_context.Queue(maxsize=queue_size)
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context, initializer=_init_import_worker, initargs=(queue,)) as executor:
+        futures = [executor.submit(_read_csv_worker, csv_path, csv_path.stem, var_types_dict[csv_path.stem], chunksize) for csv_path in csv_paths if csv_path.stem in var_types_dict]
+        n_files_done = [0]  # the number of files whose reading has ended, as counted by _iter_queued_chunks
+        try:
+            n_rows_dict = _write_chunks(db_conn, _iter_queued_chunks(queue, futures, n_files_done), var_types_dict)
+        finally:
+            try:
+                while n_files_done[0] < len(futures):  # drain the queue so that no worker is left blocked on it
+                    if not isinstance(_get_queued_chunk(queue, futures)[1], pd.DataFrame):
+                        n_files_done[0] += 1
+            except Exception:
+                pass  # a failed worker has nothing more to drain
+    elapsed = time.time()-start
+    n_rows = sum(n_rows_dict.values())
+    print(f'{len(n_rows_dict)} tables are created in the database with {n_rows} rows ({n_rows/max(elapsed, 1e-9):.0f} rows per second)')
+    for tbl_name, indx_vars in indx_vars_dict.items():
+        if tbl_name not in n_rows_dict:
+            continue
+        for var in indx_vars:
+            cur.execute(f"CREATE INDEX IDX_{tbl_name}_{var} ON {tbl_name}({var})")
+            print(f'.... The index: IDX_{tbl_name}_{var} is created for the table: {tbl_name} in the database')
+    db_conn.commit()
+    return n_rows_dict
+
+
+_import_queue = None  # The queue of the chunks read by the current worker process of import_csv_dir
+
+
+def _init_import_worker(queue):
+    global _import_queue
+    _import_queue = queue
+
+
+def _read_csv_worker(csv_path: Path, tbl_name: str, var_types: dict, chunksize: int):
+    # Reads and cleans the input csv file in chunks and puts each chunk in the queue as (table name, chunk). The end of the file is marked by (table name, None), or by (table name, exception) if the file can not be read.
+    try:
+        for df in pd.read_csv(csv_path, encoding='unicode-escape', dtype=str, chunksize=chunksize):
+            _import_queue.put((tbl_name, _clean_csv_chunk(df, var_types)))
+    except Exception as err:
+        _import_queue.put((tbl_name, err))
+        return
+    _import_queue.put((tbl_name, None))
+
+
+def _iter_queued_chunks(queue, futures: list, n_files_done: list):
+    # Yields the (table name, chunk) pairs put in the queue by the workers until the reading of the files of all the futures has ended, while counting the ended files in n_files_done[0]. The exception of a file that could not be read is raised.
+    while n_files_done[0] < len(futures):
+        tbl_name, chunk = _get_queued_chunk(queue, futures)
+        if isinstance(chunk, pd.DataFrame):
+            yield tbl_name, chunk
+            continue
+        n_files_done[0] += 1
+        if chunk is not None:
+            raise Exception(f"Table {tbl_name} could not be read!") from chunk
+
+
+def _get_queued_chunk(queue, futures: list) -> tuple:
+    # Waits for the next item in the queue while making sure that the workers are still alive (e.g. not killed for running out of memory)
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            for future in futures:
+                if future.done() and future.exception() is not None:
+                    raise Exception("A worker process of the import has failed!") from future.exception()
+
+
+def _write_chunks(db_conn, chunks, var_types_dict: dict) -> dict:
+    # Inserts the input (table name, cleaned chunk) pairs into new typed tables, where each table is created with its first chunk. Everything is inserted in a single transaction with relaxed journaling and synchronization, which is rolled back if anything fails (including a table of var_types_dict without any rows). Returns the number of inserted rows of each table.
+    cur = db_conn.cursor()
+    if db_conn.in_transaction:
+        db_conn.commit()
+    pragmas = {pragma: cur.execute(f'PRAGMA {pragma}').fetchone()[0] for pragma in ('synchronous', 'journal_mode')}
+    cur.execute('PRAGMA synchronous=OFF')
+    cur.execute('PRAGMA journal_mode=MEMORY')
+    n_rows_dict = {}
+    insert_expr_dict = {}
+    try:
+        cur.execute('BEGIN')
+        for tbl_name, df in chunks:
+            if tbl_name not in insert_expr_dict:
+                cur.execute(_get_create_table_expr(tbl_name, list(df.columns), var_types_dict[tbl_name]))
+                insert_expr_dict[tbl_name] = f'INSERT INTO "{tbl_name}" VALUES ({", ".join(["?"]*len(df.columns))})'
+            cur.executemany(insert_expr_dict[tbl_name], df.itertuples(index=False, name=None))
+            n_rows_dict[tbl_name] = n_rows_dict.get(tbl_name, 0)+len(df)
+        for tbl_name in var_types_dict:
+            if n_rows_dict.get(tbl_name, 0) == 0:
+                raise Exception(f"The csv file of table {tbl_name} does not include any rows!")
+        db_conn.commit()
+    except BaseException:
+        db_conn.rollback()
+        raise
+    finally:
+        cur.execute(f"PRAGMA journal_mode={pragmas['journal_mode']}")
+        cur.execute(f"PRAGMA synchronous={pragmas['synchronous']}")
+    return n_rows_dict
+
+
+def _clean_csv_chunk(df: pd.DataFrame, var_types: dict) -> pd.DataFrame:
+    # Cleans a chunk of strings read from a csv file as prep_data_for_db does and converts it for insertion into a typed table (see _to_typed_df), where the missing values are replaced by None
+    df.columns = [var.replace(".", "_") for var in df.columns]
+    for var in df.columns:
+        df[var] = df[var].str.replace("'", "", regex=False)
+    df = _to_typed_df(df, var_types).astype(object)
+    return df.where(df.notna(), None)  # missing values are stored as NULL
+
+
+def _to_typed_df(df: pd.DataFrame, var_types: dict) -> pd.DataFrame:
+    # Returns a copy of the input dataframe where the dates are normalized into ISO 8601 strings. Continuous variables are left as is since they are converted into numbers by the REAL affinity of their columns.
+    df = df.copy()
+    for var in df.columns:
+        if var_types.get(var) in DT_VAR_TYPES:
+            df[var] = _to_iso_dt(df[var])
+    return df
+
+
+def _to_iso_dt(col: pd.Series) -> pd.Series:
+    # Converts the input dates into ISO 8601 strings, where dates at midnight are written without a time. Values that can not be parsed as dates are kept as is.
+    dts = pd.to_datetime(col, errors='coerce')
+    if not pd.api.types.is_datetime64_dtype(dts):  # e.g. mixed time zones
+        return col
+    iso_dts = dts.dt.strftime('%Y-%m-%d %H:%M:%S').where(dts != dts.dt.normalize(), dts.dt.strftime('%Y-%m-%d'))
+    return iso_dts.where(dts.notna(), col)
+
+
+def _get_create_table_expr(tbl_name: str, var_names: list, var_types: dict) -> str:
+    # Returns the statement creating a table of the input variables with the column types of their metadata types (see _get_sql_type). Variables without metadata are stored as TEXT.
+    col_defs = ', '.join(f'"{var}" {_get_sql_type(var_types.get(var, "TEXT"))}' for var in var_names)
+    return f'CREATE TABLE "{tbl_name}" ({col_defs})'
+
+
+def _get_sql_type(var_type: str) -> str:
+    # Returns the type of the database column that stores a variable of the input metadata type, as per the mapping of the variable types in RandomQuery._map_vars
+    if var_type in CNT_VAR_TYPES:
+        return 'REAL'
+    elif var_type in CAT_VAR_TYPES+DT_VAR_TYPES+IGN_VAR_TYPES:
+        return 'TEXT'
+    else:
+        raise Exception(f"Variable type {var_type} in metadata file is not recognized!")
+
+
+
+
+def advise_indexes(db_path: str, real_tbl_lst: list, metadata_lst: list, syn_tbl_lst: list, n_queries=100, query_obj=None, max_index_vars=4, max_indexes_per_tbl=3, min_support=0.05, apply=True, max_query_time=5) -> tuple:
+    ''' Proposes composite and covering indexes for the input real tables based on a sample workload of random aggregate-filter and filter queries, and optionally creates the same indexes on both the real tables and their synthetic twins.
+    For each sampled query, the candidate index of each queried table starts with the child joining keys (as per the parent_details of the metadata), followed by the variables used in equality (=, IN) WHERE terms in descending order of their cardinality and at most one variable used in a range (<, >, BETWEEN..) WHERE term. For aggregate queries, the remaining range variables, the GROUP BY variables and the aggregated variable are appended in the order of their names so that the index covers the query if it fits within max_index_vars. No index includes all the variables of its table. WHERE terms that can not use an index (e.g. NOT, <>, LIKE) and queries combining WHERE terms by OR contribute no filter variables.
+    Candidates with the same variables in a different order are merged into the most used one and candidates that are prefixes of other candidates are merged into them, and the candidates used by the largest number of queries are proposed. The latency of the sample workload is measured before and after creating the indexes, where the workload is executed once beforehand so that both measurements run against a warm page cache. The statistics of the query planner are not updated (i.e. ANALYZE is not run), so the latency after indexing reflects the effect of the new indexes only.
+
+    Args:
+        db_path: The full path to the sqlite database where the real and synthetic tables exist.
+        real_tbl_lst: A list of real table names (strings). The list may include related tables.
+        metadata_lst: A list of the metadata dictionaries of the real tables.
+        syn_tbl_lst: A list of synthetic table names (strings) in the same order of real_tbl_lst. The proposed indexes are created on them too. Pass an empty list to index the real tables only.
+        n_queries: The number of sampled queries in the workload. Half of the queries are aggregate-filter queries and the other half are filter queries.
+        query_obj: An optional RandomQuery object of the real tables whose attributes (e.g. the operations and their probabilities or fix_seed) shape the sampled workload. If not provided, a new object is created.
+        max_index_vars: The maximum number of variables in each proposed index.
+        max_indexes_per_tbl: The maximum number of proposed indexes for each table.
+        min_support: The minimum fraction of the sampled queries that shall use a candidate index for the index to be proposed.
+        apply: If set to True (default), the proposed indexes are created in the database and the latency of the workload is measured again. Otherwise, only the latency before indexing is measured.
+        max_query_time: The maximum time in seconds allowed for executing each query of the workload. A query that takes longer is aborted and counted as taking max_query_time.
+
+    Returns:
+        A dataframe of the proposed indexes with their tables, variables and the number of the sampled queries that use them.
+        A dataframe of the latencies in seconds of each sampled query against the real and synthetic tables before and, if apply is True, after indexing, along with whether each query exceeded max_query_time (the 'timeout_' columns).
+    '''
+
+    own_query_obj = query_obj is None
+    if own_query_obj:
+        query_obj = RandomQuery(db_path, real_tbl_lst, metadata_lst)
+    assert len(syn_tbl_lst) in (0, len(real_tbl_lst)), "The number of the synthetic tables shall match the number of the real tables"
+
+    # Sample the workload and derive one candidate index per queried table per query
+    cand_counts = {}  # (real table name, tuple of var names) -> number of queries
+    tbl_n_vars = {tbl_name: len(metadata['table_vars']) for tbl_name, metadata in zip(real_tbl_lst, metadata_lst)}
+    workload = []
+    try:
+        for k in range(n_queries):
+            if k % 2 == 0:
+                real_expr, _, _, _, (log_op, cnt_var) = query_obj.compile_aggfltr_expr()
+            else:
+                (real_expr, _, _), cnt_var = query_obj.compile_fltr_expr(), 'None'
+            workload.append(real_expr)
+            for tbl_name, var_names in _get_query_index_cands(query_obj.last_expr_terms(), cnt_var, max_index_vars, tbl_n_vars).items():
+                cand_counts[(tbl_name, var_names)] = cand_counts.get((tbl_name, var_names), 0)+1
+        workload_syn = [query_obj.make_syn_expr(syn_tbl_lst, real_expr) for real_expr in workload] if len(syn_tbl_lst) != 0 else []
+    finally:
+        if own_query_obj:
+            query_obj.close()
+
+    # Merge the candidates of the same table with the same variables in a different order into the most used one, and then each candidate into the most used longer candidate of the same table that starts with it
+    for (tbl_name, var_names) in sorted(cand_counts, key=lambda cand: (cand_counts[cand], cand[1])):
+        same_cands = [cand for cand in cand_counts if cand[0] == tbl_name and cand[1] != var_names and set(cand[1]) == set(var_names)]
+        if len(same_cands) != 0:
+            same_cand = max(same_cands, key=lambda cand: cand_counts[cand])
+            cand_counts[same_cand] += cand_counts.pop((tbl_name, var_names))
+    for (tbl_name, var_names) in sorted(cand_counts, key=lambda cand: len(cand[1])):
+        longer_cands = [cand for cand in cand_counts if cand[0] == tbl_name and len(cand[1]) > len(var_names) and cand[1][:len(var_names)] == var_names]
+        if len(longer_cands) != 0:
+            longer_cand = max(longer_cands, key=lambda cand: cand_counts[cand])
+            cand_counts[longer_cand] += cand_counts.pop((tbl_name, var_names))
+    index_lst = []
+    for tbl_name in real_tbl_lst:
+        tbl_cands = sorted([cand for cand in cand_counts if cand[0] == tbl_name], key=lambda cand: (-cand_counts[cand], cand[1]))
+        for cand in tbl_cands[:max_indexes_per_tbl]:
+            if cand_counts[cand] >= min_support*n_queries:
+                index_lst.append({'table_name': tbl_name, 'index_vars': list(cand[1]), 'n_queries': cand_counts[cand]})
+    index_df = pd.DataFrame(index_lst, columns=['table_name', 'index_vars', 'n_queries'])
+    print(f'{len(index_df)} indexes are proposed based on {n_queries} sampled queries')
+
+    latency_df = pd.DataFrame({'sql_real': workload})
+    db_conn = sqlite3.connect(db_path)
+    try:
+        for expr in workload+workload_syn:  # warm up the page cache so that the first timed pass is not penalized by cold reads
+            _time_query(db_conn, expr, max_query_time)
+        _add_latency_cols(latency_df, 'before', db_conn, workload, workload_syn, max_query_time)
+        if apply:
+            cur = db_conn.cursor()
+            for index in index_lst:
+                tbl_names = [index['table_name']]
+                if len(syn_tbl_lst) != 0:
+                    tbl_names.append(syn_tbl_lst[real_tbl_lst.index(index['table_name'])])
+                for tbl_name in tbl_names:
+                    index_name = f"IDX_{tbl_name}_{'_'.join(index['index_vars'])}"
+                    cur.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {tbl_name}({', '.join(index['index_vars'])})")
+                    print(f'.... The index: {index_name} is created for the table: {tbl_name} in the database')
+            db_conn.commit()
+            _add_latency_cols(latency_df, 'after', db_conn, workload, workload_syn, max_query_time)
+    finally:
+        db_conn.close()
+    for time_col in [col for col in latency_df.columns if col.startswith('time_')]:
+        n_timeouts = latency_df['timeout'+time_col[len('time'):]].sum()
+        print(f'.... Total {time_col}: {latency_df[time_col].sum():.3f} seconds, where {n_timeouts} queries exceeded max_query_time')
+    return index_df, latency_df
+
+
+def _add_latency_cols(latency_df: pd.DataFrame, stage: str, db_conn, workload: list, workload_syn: list, max_query_time):
+    # Adds the latencies of the real (and synthetic) workload at the input stage ('before' or 'after' indexing) to latency_df along with whether each query exceeded max_query_time
+    for side, exprs in [('real', workload), ('syn', workload_syn)]:
+        if len(exprs) != 0:
+            times = [_time_query(db_conn, expr, max_query_time) for expr in exprs]
+            latency_df[f'time_{stage}_{side}'] = [elapsed for elapsed, _ in times]
+            latency_df[f'timeout_{stage}_{side}'] = [is_timeout for _, is_timeout in times]
+
+
+def _get_query_index_cands(expr_terms: dict, cnt_var: str, max_index_vars: int, tbl_n_vars: dict) -> dict:
+    # Returns a dictionary of the candidate index (tuple of var names) of each table in the input structured terms of a compiled query (see RandomQuery.last_expr_terms). The variables that follow the filter variables are sorted by name so that the same set of variables makes the same candidate, and no candidate includes all the variables of its table (as per tbl_n_vars).
+    from_tbl = expr_terms['from_tbl']
+
+    def split_var(var):
+        return var.split('.') if '.' in var else (from_tbl, var)
+
+    tbl_vars = {from_tbl: {'keys': [], 'eq': [], 'range': [], 'other': []}}
+    for parent, child, join_type in expr_terms['joins']:
+        tbl_vars[child] = {'keys': list(expr_terms['join_keys'][child]), 'eq': [], 'range': [], 'other': []}
+    use_fltr = 'OR' not in expr_terms.get('logic_ops', [])
+    n_distinct_dict = {}  # (table name, var name) -> number of distinct values
+    for where_term in expr_terms.get('where_terms', []):
+        n_distinct_dict[(where_term['tbl_name'], where_term['var_name'])] = where_term['n_distinct']
+        if not use_fltr or where_term['is_not']:
+            kind = 'other'
+        elif where_term['op'] in ('=', 'IN'):
+            kind = 'eq'
+        elif where_term['op'] in ('<', '>', '<=', '>=', 'BETWEEN'):
+            kind = 'range'
+        else:  # <>, LIKE and NOT terms
+            kind = 'other'
+        tbl_vars[where_term['tbl_name']][kind].append(where_term['var_name'])
+    for var in expr_terms.get('groupby_lst', [])+([] if cnt_var == 'None' else [cnt_var]):
+        tbl_name, var_name = split_var(var)
+        tbl_vars[tbl_name]['other'].append(var_name)
+
+    cands = {}
+    is_agg = 'groupby_lst' in expr_terms
+    for tbl_name, var_dict in tbl_vars.items():
+        eq_vars = sorted(dict.fromkeys(var_dict['eq']), key=lambda var_name: (-n_distinct_dict[(tbl_name, var_name)], var_name))
+        key_vars = list(dict.fromkeys(var_dict['keys']+eq_vars+var_dict['range'][:1]))
+        index_vars = key_vars+sorted(set(var_dict['range']+var_dict['other'])-set(key_vars)) if is_agg else key_vars
+        max_vars = min(max_index_vars, tbl_n_vars[tbl_name]-1)  # an index of the whole table would copy it
+        if is_agg and len(index_vars) <= max_vars:  # covering
+            key_vars = index_vars
+        if len(key_vars[:max_vars]) != 0:
+            cands[tbl_name] = tuple(key_vars[:max_vars])
+    return cands
+
+
+def _time_query(db_conn, query_exp: str, max_query_time) -> tuple:
+    # Returns the time in seconds taken to execute the input query and fetch its results, which is capped at max_query_time, and whether the query was aborted for exceeding max_query_time
+    start = time.monotonic()
+    deadline = start+max_query_time
+    is_timeout = False
+    db_conn.set_progress_handler(lambda: time.monotonic() > deadline, 1000)
+    try:
+        db_conn.execute(query_exp).fetchall()
+    except sqlite3.OperationalError:
+        if time.monotonic() <= deadline:
+            raise
+        is_timeout = True
+    finally:
+        db_conn.set_progress_handler(None, 0)
+    return min(time.monotonic()-start, max_query_time), is_timeout
@@ -5,12 +5,26 @@ import sqlite3
 import numpy as np
 import pandas as pd
 import copy
-import random
-import multiprocess as mp
+import time
+import os
+import threading
+import hashlib
+import pickle
+import re
+import contextlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait
 from typing import Union, Tuple
 
 from scipy.stats import gaussian_kde
-from scipy.integrate import quad
+from scipy.integrate import quad, trapezoid
+from scipy.signal import fftconvolve
+
+# The vocabulary of the variable types in the metadata, which are mapped to CNT, CAT, DT or IGN (see RandomQuery._map_vars)
+CNT_VAR_TYPES = ['quantitative', 'continuous', 'interval', 'ratio', 'REAL']
+CAT_VAR_TYPES = ['qualitative', 'categorical', 'nominal', 'discrete', 'ordinal', 'dichotomous', 'TEXT', 'INTEGER', 'UNQID', 'ID', 'KEY', 'key']
+DT_VAR_TYPES = ['date', 'time', 'datetime']
+IGN_VAR_TYPES = ['ignore', 'IGNORE']
 
 
 
@@ -19,13 +33,16 @@ from scipy.integrate import quad
 
 class RandomQuery():
 
-    def __init__(self, db_path: str, tbl_names_lst: list,  metadata_lst: list):
+    def __init__(self, db_path: str, tbl_names_lst: list,  metadata_lst: list, val_bag_mode: str = 'full', n_quantiles: int = 1000, lazy: bool = False):
         """ Generates a random query for tabular and longitudinal datasets. 
 
         Args:
             db_path (string): The full path to the sqlite databse where the data exists.
             tbl_names_lst (list of str) : A list of input table names (strings) in the database to be randomly queried. 
             metadata_lst (list of dict): A list of dictionaries comprising the types of variables and relationships pertaining to each input table. Each dictionary shall conform to the metadata schema.
+            val_bag_mode (string): How the values of each variable are kept in memory for sampling the literals of the WHERE clause. The default 'full' keeps all the non-missing values of each variable. 'distinct' keeps only the distinct values along with their counts (computed in the database) and samples them with the same frequency weighting, while continuous variables with more than n_quantiles distinct values are summarized by a quantile sketch. Use 'distinct' to make the memory grow with the cardinality of the variables rather than the number of rows.
+            n_quantiles (int): The number of quantiles in the sketch of a continuous variable when val_bag_mode is 'distinct'.
+            lazy (bool): If set to True, val_bag_mode is set to 'distinct' whatever its input value. The input tables are never read as a whole into memory in either mode, the value bags are built by streaming each variable (or its aggregates in 'distinct' mode) from the database in chunks. Use it for tables whose variables have too many values to be kept in memory.
 
         """
 
@@ -34,7 +51,7 @@ class RandomQuery():
         assert len(tbl_names_lst) == len(
             metadata_lst), "Each input table name shall have its own metadata dictionary."
 
-        #: A boolean for setting the seed. Default is False and hence the query results will vary from one object to another.
+        #: A boolean for setting the seed. If set to True, the random generator of the object is seeded with a fixed seed the next time a query is compiled, so that the same sequence of (distinct) queries is generated by any object. Default is False and hence the query results will vary from one object to another. See also reseed.
         self.fix_seed = False
 
         # Define random query possible operations
@@ -94,6 +111,54 @@ class RandomQuery():
         #: The fixed number of join terms (tables) to be used in the JOIN clause. It does not include the name of the master parent table (i.e. the table directly following 'FROM; in the SELECT statement). Set it to np.inf to randomly select the number of JOIN terms.
         self.no_join_tables: int = np.inf
 
+        #: The number of SQLite virtual machine instructions between two successive checks of the query execution time against max_query_time. Smaller numbers abort long queries more promptly at a slightly higher overhead.
+        self.progress_check_steps: int = 1000
+
+        #: The maximum number of bytes of the database file that each read-only connection accesses through memory-mapped I/O (PRAGMA mmap_size). Set it to 0 to disable memory mapping. It applies to the connections opened afterwards.
+        self.mmap_size: int = 2**30
+
+        #: The page cache size of each read-only connection (PRAGMA cache_size). As per SQLite, a negative number sets the size in KiB while a positive number sets it in pages. It applies to the connections opened afterwards.
+        self.cache_size: int = -262144
+
+        #: The number of rows fetched at a time from the database whenever the rows are streamed in chunks (e.g. when building value bags).
+        self.fetch_chunk_size: int = 100000
+
+        #: The path to a directory where the query results are cached on disk across runs. Each result is keyed by its normalized SQL and the fingerprints of the schema and content of the tables it reads, so a result is reused for as long as these tables do not change (e.g. the real-side results when only a synthetic table is replaced). The fingerprints are persisted in the same directory, so a table is hashed again only after the database file changes. The default None disables caching.
+        self.result_cache_dir: str = None
+
+        #: The method of calculating the Hellinger distance of continuous variables. The default 'grid' evaluates the Gaussian kernel density estimates (with the same bandwidths of scipy's gaussian_kde) on a grid of hlngr_grid_size points using FFT convolution and integrates them numerically. 'hist' compares the histograms of the real and synthetic values over shared bins whose width follows the Freedman-Diaconis rule on the pooled values (with at most hlngr_grid_size bins), which is the fastest but the coarsest. 'kde_quad' integrates the gaussian_kde estimates using scipy's adaptive quad, which is the slowest and may take minutes for large query results.
+        self.hlngr_cnt_method: str = 'grid'
+
+        #: The number of grid points used by the 'grid' method of calculating the Hellinger distance of continuous variables, which is also the maximum number of bins of the 'hist' method. Larger numbers are more accurate but slower.
+        self.hlngr_grid_size: int = 1024
+
+        #: If set to True, the real and synthetic halves of each twin query are executed at the same time, where the synthetic half runs on a helper thread with its own database connection. The twin query then takes about as long as the slower of its halves. Set it to False to execute the halves one after the other.
+        self.twin_concurrent: bool = True
+
+        #: If set to True, the real and synthetic aggregate (and aggregate-filter) queries of each twin are executed as a single compound statement that returns the groups of both queries already matched (see _match_queries4agg). The timeout max_query_time then applies to the compound statement. The default False executes the real and synthetic queries separately.
+        self.twin_single_pass: bool = False
+
+        #: If set to True, the category counts of the categorical variables are computed inside the database, so that only the (value, count) pairs are fetched. Each side of a filter (or tabular) query is executed as a GROUP BY statement per categorical variable and a single statement fetching the non-categorical variables, which are the only variables kept in the results dataframes. The timeout max_query_time then applies to all the statements of each side together. The filter is executed once per statement, so it pays off mostly for results with many rows and few categorical variables. The default False fetches all the variables of the results.
+        self.hlngr_pushdown: bool = False
+
+        #: The maximum number of rows of each of the real and synthetic filter query results used in calculating the Hellinger distances. If either result has more rows, the distances are estimated from a uniform random sample of that many rows and each estimate is reported with a bootstrap confidence interval in the Hellinger breakdown. The sample is kept while the rows are fetched (i.e. a reservoir sample), so the results of make_twin_fltr_query hold the sampled rows only while the numbers of rows in their description count all the rows. The sampling draws from generators spawned off the seed of the object, so it does not change the queries compiled afterwards. The default None uses all the rows (i.e. exact distances).
+        self.hlngr_sample_size: int = None
+
+        #: The number of bootstrap resamples used for the confidence intervals of the estimated Hellinger distances when hlngr_sample_size is set.
+        self.hlngr_n_bootstraps: int = 50
+
+        #: The confidence level of the intervals of the estimated Hellinger distances when hlngr_sample_size is set.
+        self.hlngr_ci_level: float = 0.95
+
+        #: The window (min, max) of the estimated number of rows returned by the compiled query expressions, i.e. the filtered rows of filter queries or the groups of aggregate queries. If set, the compile methods keep resampling the expression until its estimate (see estimate_last_expr) falls within the window, e.g. (1, np.inf) avoids the expressions that are expected to return nothing. The estimates are computed from statistics of the value bags without executing anything. The default None accepts any expression.
+        self.est_rows_window: tuple = None
+
+        #: The maximum estimated cost of the compiled query expressions in rows read and joined by the database (see estimate_last_expr). If set, the compile methods keep resampling the expression until its estimated cost does not exceed it, which avoids the expressions that would likely exceed max_query_time. The default None accepts any expression.
+        self.est_max_cost: float = None
+
+        #: The maximum number of expressions compiled in search of one that satisfies est_rows_window and est_max_cost, after which the last compiled expression is used anyway.
+        self.est_max_resamples: int = 100
+
         # validate metadata schema
         validator = Draft4Validator(self._get_metdata_schema())
         for i, metadata in enumerate(metadata_lst):
@@ -109,8 +174,29 @@ class RandomQuery():
             raise TypeError(
                 "Dictionary of defined operations did not pass schema validation!")
 
+        assert val_bag_mode in ('full', 'distinct'), "Please choose either 'full' or 'distinct' for val_bag_mode"
+        val_bag_mode = 'distinct' if lazy else val_bag_mode
+
         self._seed_no = 141
+        self._seed_seq = np.random.SeedSequence()  # The seed sequence of the generator, from which the independent generators of row sampling are spawned (see _spawn_rng)
+        self._rng = np.random.default_rng(self._seed_seq)  # The random generator of all the random choices of the object (see reseed)
+        self._is_rng_fixed = False  # whether the generator was seeded for fix_seed
         self._db_path=db_path
+        self._init_kwargs = {'val_bag_mode': val_bag_mode, 'n_quantiles': n_quantiles, 'lazy': lazy}  # Construction options to be reused by any replica of the object (e.g. parallel workers)
+        self._val_bag_mode = val_bag_mode
+        self._n_quantiles = n_quantiles
+        self._conn_pool = threading.local()  # One long-lived read-only connection per thread
+        self._conn_lst = []  # All the connections opened by this object so that they can be closed
+        self._conn_lock = threading.Lock()
+        self._syn_valid_cache = {}  # The database data_version at which each list of synthetic tables was last validated
+        self._tbl_fprint_cache = {}  # (table name, connection id) -> (data_version, fingerprint of the table)
+        self._twin_executor = None  # The helper thread for the synthetic halves of twin queries (see _run_twin)
+        self._twin_executor_pid = None
+        self._compiled_terms = {}  # The structured terms of the last compiled expression (see estimate_last_expr)
+        self._col_stats_dict = {}  # (table name, var name) -> statistics of the value bag (see _get_col_stats)
+        self._tbl_stats_dict = {}  # table name -> (number of rows, var name -> number of non-missing values)
+        self._join_rows_dict = {}  # (parent, child, join type) -> number of rows of the parent joined to the child
+        self._col_affinity_dict = {}  # (table name, var name) -> type affinity of the column in the database
         self._tbl_name_lst = tbl_names_lst
         self._parent_name_lst, self._child_name_lst, self._sole_name_lst = self._classify_tables(
             tbl_names_lst, metadata_lst)
@@ -120,25 +206,27 @@ class RandomQuery():
         for metadata_i in metadata_lst:
             mod_metadata_lst.append(self._map_vars(metadata_i))
         self._metadata_lst = mod_metadata_lst  # A list of dictionaries for each table
+        self._build_metadata_indexes()
 
-        # Construct list of input tables as pandas dataframes for value bags
-        mod_tbl_lst = []
-        conn=sqlite3.connect(db_path)
-        with conn:
-            for tbl_name in tbl_names_lst:
-                df = pd.read_sql_query(f'SELECT * FROM {tbl_name}', conn)
-                mod_tbl_lst.append(df)
-        self._tbl_lst = mod_tbl_lst
-
-        # Generate value lists
-        self._val_lst = []
-        for i, tbl_name in enumerate(self._tbl_name_lst):
-            val_dict = {}
-            val_dict['table_name'] = tbl_name
-            for j, var_tpl in enumerate(metadata_lst[i]['table_vars']):
-                val_dict[var_tpl[0]] = self._make_val_bag(
-                    tbl_name, metadata_lst[i]['table_vars'][j][0])
-            self._val_lst.append(val_dict)
+        # Construct the value lists of the input tables. They are built once and reused by all the queries generated by this object.
+        self._val_lst = [None]*len(tbl_names_lst)
+        self._load_tables(tbl_names_lst)
+
+    def reload_tables(self, tbl_names_lst: list):
+        """ Rebuilds the value bags of the input tables from the database and drops their cached statistics while keeping everything else in the object as is. Call it whenever the content of some input tables changes in the database so that the same object can be reused for generating further queries.
+
+        Args:
+            tbl_names_lst (list of str): A list of table names to be reloaded. Each table shall be one of the tables passed to the object at construction.
+
+        """
+        for tbl_name in tbl_names_lst:
+            assert tbl_name in self._tbl_name_lst, f"Table {tbl_name} is not one of the tables passed to this object!"
+        self._col_affinity_dict = {tbl_var: affinity for tbl_var, affinity in self._col_affinity_dict.items() if tbl_var[0] not in tbl_names_lst}
+        self._load_tables(tbl_names_lst)
+        self._syn_valid_cache = {}
+        self._col_stats_dict = {tbl_var: col_stats for tbl_var, col_stats in self._col_stats_dict.items() if tbl_var[0] not in tbl_names_lst}
+        self._tbl_stats_dict = {tbl_name: tbl_stats for tbl_name, tbl_stats in self._tbl_stats_dict.items() if tbl_name not in tbl_names_lst}
+        self._join_rows_dict = {join: n_rows for join, n_rows in self._join_rows_dict.items() if join[0] not in tbl_names_lst and join[1] not in tbl_names_lst}
 
 
 # Schema definitions
@@ -420,25 +508,94 @@ class RandomQuery():
 
 ########################################## COMMON METHODS  #########################
 
-    def _exec_sql4testing(self, db_path:str, sql_str:str):
-        conn=sqlite3.connect(db_path)
-        with conn:
-            cur = conn.cursor()
-            res=cur.execute(sql_str)
-            #print(res.fetchone())
-        
+    def _open_conn(self):
+        # Opens a read-only connection to the database since random queries never write into it.
+        db_uri = Path(self._db_path).resolve().as_uri()+'?mode=ro'
+        conn = sqlite3.connect(db_uri, uri=True, check_same_thread=False)  # each connection is used by its own thread only, but close() may be called from another one
+        conn.execute('PRAGMA query_only = ON')
+        conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+        conn.execute(f'PRAGMA cache_size = {int(self.cache_size)}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        return conn
+
+    def _get_conn(self):
+        # Returns the warm connection of the current thread, opening it on first use. A process (e.g. a parallel worker) never reuses connections inherited from its parent.
+        pool = self._conn_pool
+        if getattr(pool, 'conn', None) is None or pool.pid != os.getpid():
+            pool.conn = self._open_conn()
+            pool.pid = os.getpid()
+            with self._conn_lock:
+                self._conn_lst.append(pool.conn)
+        return pool.conn
+
+    def close(self):
+        """ Closes all the database connections opened by the object in the current process. The object remains usable, and new connections are opened whenever needed.
 
-    def _test_query_time(self,db_path,query_expr, max_query_time=5):
-        p = mp.Process(target=self._exec_sql4testing, name="_test_query_time", args=(db_path,query_expr))
-        p.start()
-        p.join(5)  # wait 5 seconds until process terminates
-        if p.is_alive():
-            p.terminate()
-            p.join()
-            print('Cant wait any further! I am skipping this one!')  # MK TEMP
-            return False  # execution time is too long
-        else:
-            return True  # execution time is ok
+        """
+        if self._twin_executor is not None and self._twin_executor_pid == os.getpid():
+            self._twin_executor.shutdown(wait=True)
+        self._twin_executor = None
+        with self._conn_lock:
+            for conn in self._conn_lst:
+                try:
+                    conn.close()
+                except sqlite3.ProgrammingError:  # connection created in another thread
+                    continue
+            self._conn_lst = []
+        self._conn_pool = threading.local()
+        self._syn_valid_cache = {}
+        self._tbl_fprint_cache = {}
+
+    def reseed(self, seed=None, query_no: int = None):
+        """ Resets the random generator that is used by the object for compiling random queries. 
+
+        Args:
+            seed: The seed (integer) of the generator. The default None seeds it with fresh entropy from the operating system.
+            query_no: An optional query number. If provided, the generator is set to the independent child stream of the query number derived from seed, which is the stream that numpy.random.SeedSequence(seed).spawn would assign to it. So the query number k can be regenerated alone without generating the queries before it, and the queries generated in parallel by different processes are reproducible.
+
+        """
+        seed_seq = np.random.SeedSequence(seed)
+        if query_no is not None:
+            seed_seq = np.random.SeedSequence(seed_seq.entropy, spawn_key=(query_no,))
+        self._seed_seq = seed_seq
+        self._rng = np.random.default_rng(seed_seq)
+        self._is_rng_fixed = True
+
+    def _get_rng(self) -> np.random.Generator:
+        # Returns the random generator of the object after seeding it with the fixed seed if fix_seed was set since the last reseeding
+        if self.fix_seed and not self._is_rng_fixed:
+            self.reseed(self._seed_no)
+        return self._rng
+
+    def _spawn_rng(self) -> np.random.Generator:
+        # Returns a new generator from the next child of the seed sequence of the object generator. The stream of the object generator is not consumed, so sampling the query results does not change the queries compiled afterwards, while seeded runs remain reproducible.
+        self._get_rng()  # reseeds first if fix_seed is set
+        return np.random.default_rng(self._seed_seq.spawn(1)[0])
+
+    def _run_twin(self, real_fn, syn_fn) -> tuple:
+        # Returns the results of calling the input functions of the real and synthetic halves of a twin query. If twin_concurrent is set, the synthetic half runs on the helper thread while the real half runs on the calling thread. Since sqlite3 releases the GIL while executing, both halves proceed in parallel.
+        if not self.twin_concurrent:
+            return real_fn(), syn_fn()
+        if self._twin_executor is None or self._twin_executor_pid != os.getpid():
+            self._twin_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='twin')
+            self._twin_executor_pid = os.getpid()
+        syn_future = self._twin_executor.submit(syn_fn)
+        try:
+            real_res = real_fn()
+        except BaseException:
+            wait([syn_future])  # do not leave the synthetic half running behind
+            raise
+        return real_res, syn_future.result()
+
+    def _load_tables(self, tbl_names_lst: list):
+        # Generates the value lists of the input tables by streaming their variables from the database. Only the entries of the input tables are replaced.
+        for tbl_name in tbl_names_lst:
+            i = self._tbl_idx_dict[tbl_name]
+            val_dict = {}
+            val_dict['table_name'] = tbl_name
+            for var_tpl in self._metadata_lst[i]['table_vars']:
+                val_dict[var_tpl[0]] = self._make_val_bag(tbl_name, var_tpl[0])
+            self._val_lst[i] = val_dict
 
     def _flatten_lst(self, lst):
         return [item for sublist in lst for item in sublist]
@@ -451,11 +608,33 @@ class RandomQuery():
             lst.remove(x)
         return lst
 
+    def _build_metadata_indexes(self):
+        # Precomputes dictionaries for the metadata lookups that are repeated for every variable of every query, so that each lookup is O(1) instead of a scan of all tables and variables
+        self._metadata_idx_dict = {}  # table name -> index in METADATA_LST
+        self._var_type_dict = {}  # (table name, var name) -> var type
+        self._tbl_var_tpls_dict = {}  # table name -> list of (table name, var name)
+        self._tbl_vars_by_type_dict = {}  # (table name, var type) -> list of var names
+        self._tbl_childs_dict = {}  # parent table name -> list of child table names
+        self._var_name_type_dict = {}  # var name -> var type, or None if the name has different types across the tables
+        for i, metadata in enumerate(self._metadata_lst):
+            tbl_name = metadata['table_name']
+            self._metadata_idx_dict.setdefault(tbl_name, i)
+            self._tbl_var_tpls_dict[tbl_name] = [(tbl_name, var_tpl[0]) for var_tpl in metadata['table_vars']]
+            for var_tpl in metadata['table_vars']:
+                self._var_type_dict.setdefault((tbl_name, var_tpl[0]), var_tpl[2])
+                self._tbl_vars_by_type_dict.setdefault((tbl_name, var_tpl[2]), []).append(var_tpl[0])
+                if self._var_name_type_dict.setdefault(var_tpl[0], var_tpl[2]) != var_tpl[2]:
+                    self._var_name_type_dict[var_tpl[0]] = None
+            for parent in metadata.get('parent_details', {}):
+                tbl_childs = self._tbl_childs_dict.setdefault(parent, [])
+                if tbl_name not in tbl_childs:
+                    tbl_childs.append(tbl_name)
+        self._tbl_idx_dict = {tbl_name: i for i, tbl_name in enumerate(self._tbl_name_lst)}  # table name -> index in the lists of tables and value bags
+        self._tbl_keys_dict = {tbl_name: self._find_table_keys(tbl_name) for tbl_name in self._metadata_idx_dict}  # table name -> list of its joining keys
+
     def _get_tbl_index(self, tbl_name):
         # lookup table index in METADATA_LST
-        for i, metadata in enumerate(self._metadata_lst):
-            if metadata['table_name'] == tbl_name:
-                return i
+        return self._metadata_idx_dict.get(tbl_name)
 
     def _classify_tables(self, tbl_names_lst, metadata_lst):
         sole_grp = []
@@ -467,7 +646,7 @@ class RandomQuery():
                 parent_grp += list(metadata['parent_details'].keys())
             else:
                 sole_grp.append(tbl_name)
-        parent_grp = list(set(parent_grp))
+        parent_grp = list(dict.fromkeys(parent_grp)) # drop duplicates while keeping the order stable across processes
         new_sole_grp = []
         for sole in sole_grp:
             if sole not in parent_grp:
@@ -487,6 +666,9 @@ class RandomQuery():
         return child_details
 
     def _get_table_keys(self, tbl_name):
+        return list(self._tbl_keys_dict[tbl_name])
+
+    def _find_table_keys(self, tbl_name):
         # if table is sole, this function is not supposed to be called!
         # if table is child, get its get keys from its metadata
         # if table is parent, search for its childs and get its keys from over there.
@@ -508,28 +690,15 @@ class RandomQuery():
 
     def _get_tbl_vars_by_type(self, var_type, tbl_name, drop_key=False):
         # Returns variable names by type (i.e CAT, CNT or DT) for the input table by referring to the corresponding metadata
-        tbl_idx = self._get_tbl_index(tbl_name)
-        fetched_vars = []
-        var_tpls = self._metadata_lst[tbl_idx]['table_vars']
-        for tpl in var_tpls:
-            if tpl[2] == var_type:
-                fetched_vars.append(tpl[0])
+        fetched_vars = list(self._tbl_vars_by_type_dict.get((tbl_name, var_type), []))
         if drop_key and var_type == 'CAT':  # Note that unique key is NOT allowed to be other than CAT type
             keys = self._get_table_keys(tbl_name)
             fetched_vars = self._remove_sublst(fetched_vars, keys)
         return fetched_vars
 
     def _get_tbl_childs(self, tbl_name: str) -> list:
-        # search thru all tables and check if tbl_name exists in parenet
-        tbl_childs = []
-        # lookup table index in METADATA_LST
-        for i, metadata in enumerate(self._metadata_lst):
-            if 'parent_details' not in metadata:
-                continue
-            parents = list(metadata['parent_details'].keys())
-            if tbl_name in parents:
-                tbl_childs.append(metadata['table_name'])
-        return list(set(tbl_childs))
+        # Returns all the tables that have tbl_name as a parent
+        return list(self._tbl_childs_dict.get(tbl_name, []))
 
     def _prepend_tbl_name(self, tbl_name, vars_lst):
         # Returns the input var names but prepended with the input table
@@ -555,13 +724,13 @@ class RandomQuery():
     def _map_vars(self, metadata: dict) -> dict:
         mod_metadata = copy.deepcopy(metadata)
         for i, var_tpl in enumerate(mod_metadata['table_vars']):
-            if var_tpl[1] in ['quantitative', 'continuous', 'interval', 'ratio', 'REAL']:
+            if var_tpl[1] in CNT_VAR_TYPES:
                 mod_metadata['table_vars'][i].append("CNT")
-            elif var_tpl[1] in ['qualitative', 'categorical', 'nominal', 'discrete', 'ordinal', 'dichotomous', 'TEXT', 'INTEGER', 'UNQID', 'ID', 'KEY', 'key']:
+            elif var_tpl[1] in CAT_VAR_TYPES:
                 mod_metadata['table_vars'][i].append("CAT")
-            elif var_tpl[1] in ['date', 'time', 'datetime']:
+            elif var_tpl[1] in DT_VAR_TYPES:
                 mod_metadata['table_vars'][i].append("DT")
-            elif var_tpl[1] in ['ignore', 'IGNORE']:
+            elif var_tpl[1] in IGN_VAR_TYPES:
                 mod_metadata['table_vars'][i].append("IGN")
             else:
                 raise Exception(
@@ -570,35 +739,119 @@ class RandomQuery():
 
     def _get_var_type(self, table_name: str, var_name: str) -> str:
         # This function gets the input variable type (CAT, CNT or DT) from the metadata and returns it
-        # i=self.TBL_NAME_LST.index(table_name) #find table index
-        # metadata=self.METADATA_LST[i] #get corresponding metadata dictionary for the table
-        for tbl_metdata in self._metadata_lst:
-            if tbl_metdata['table_name'] == table_name:
-                var_tpl_lst = tbl_metdata['table_vars']
-        assert len(
-            var_tpl_lst) != 0, f"No variables found for table {table_name}"
-        # search for variable in metadata tuples and return it type
-        for j, var_tpl in enumerate(var_tpl_lst):
-            if var_tpl[0] == var_name:
-                return var_tpl_lst[j][2]
-
-    def _make_val_bag(self, table_name: str, var_name: str) -> list:
-        i = self._tbl_name_lst.index(table_name)
-        df = self._tbl_lst[i]
-        vals = df[var_name].values
-        vals = [x for x in vals if x == x]  # drop nan
-        vals = list(filter(None, vals))  # drop None
-        var_type = self._get_var_type(table_name, var_name)
-        if var_type == 'CAT':
-            # print(table_name,var_name)
-            # for the values of categorical variables, add quote to avoid errors in SQL statement
-            vals = [
-                "'"+str(x)+"'" for x in vals if "'" not in x or '"' not in x]
-        vals = vals if len(vals) != 0 else ["'N/A'"]
-        return vals
-
-    def _get_val_bag(self, table_name: str, var_name: str) -> str:
-        i = self._tbl_name_lst.index(table_name)
+        assert len(self._tbl_var_tpls_dict.get(table_name, [])) != 0, f"No variables found for table {table_name}"
+        return self._var_type_dict.get((table_name, var_name))
+
+    def _make_val_bag(self, table_name: str, var_name: str) -> Union[np.ndarray, pd.Series]:
+        # Returns the non-missing values of the input variable as a typed numpy array read straight from the database. If val_bag_mode is 'distinct', a series of counts indexed by the distinct values is returned instead (see _make_distinct_val_bag). Values are not quoted here, see _quote_val.
+        if self._val_bag_mode == 'distinct':
+            return self._make_distinct_val_bag(table_name, var_name)
+        cur = self._get_conn().execute(f"SELECT {var_name} FROM {table_name} WHERE {var_name} IS NOT NULL AND {var_name} <> ''")
+        vals = np.fromiter((row[0] for row in cur), dtype=object)
+        if len(vals) == 0:
+            return np.array(['N/A'], dtype=object)
+        return self._to_typed_array(vals, self._is_numeric_col(table_name, var_name))
+
+    def _iter_chunks(self, cur):
+        # Yields the rows returned by the input cursor in lists of at most fetch_chunk_size rows
+        while True:
+            rows = cur.fetchmany(self.fetch_chunk_size)
+            if len(rows) == 0:
+                return
+            yield rows
+
+    def _make_distinct_val_bag(self, table_name: str, var_name: str) -> pd.Series:
+        # Counts the distinct values of the input variable in the database and returns the counts as a series indexed by the values. A continuous variable with more than n_quantiles distinct values is summarized by the values at n_quantiles equally spaced quantiles (see _make_quantile_sketch). The counts are streamed from the database in chunks.
+        conn = self._get_conn()
+        not_missing = f"{var_name} IS NOT NULL AND {var_name} <> ''"
+        n_distinct, n_vals = conn.execute(f"SELECT COUNT(DISTINCT {var_name}), COUNT(*) FROM {table_name} WHERE {not_missing}").fetchone()
+        if n_vals == 0:
+            return pd.Series([1], index=np.array(['N/A'], dtype=object))
+        cur = conn.execute(f"SELECT {var_name}, COUNT(*) FROM {table_name} WHERE {not_missing} GROUP BY {var_name} ORDER BY {var_name}")
+        if self._get_var_type(table_name, var_name) == 'CNT' and n_distinct > self._n_quantiles:
+            vals, freqs = self._make_quantile_sketch(self._iter_chunks(cur), n_vals)
+        else:
+            vals, freqs = [], []
+            for rows in self._iter_chunks(cur):
+                vals.append(np.fromiter((row[0] for row in rows), dtype=object, count=len(rows)))
+                freqs.append(np.fromiter((row[1] for row in rows), dtype=np.int64, count=len(rows)))
+            vals, freqs = np.concatenate(vals), np.concatenate(freqs)
+        return pd.Series(freqs, index=self._to_typed_array(vals, self._is_numeric_col(table_name, var_name)))
+
+    def _make_quantile_sketch(self, chunks, n_vals: int) -> tuple:
+        # Picks the values at n_quantiles equally spaced quantiles from the input chunks of (value, count) rows sorted by value, where n_vals is the total count. Only the picked values are kept in memory. Returns the picked distinct values along with how many quantiles each one covers.
+        targets = (np.arange(self._n_quantiles)+0.5)*n_vals/self._n_quantiles
+        vals, freqs = [], []
+        cum_freq = 0
+        for rows in chunks:
+            chunk_freqs = np.fromiter((row[1] for row in rows), dtype=np.int64, count=len(rows))
+            cum_freqs = cum_freq+np.cumsum(chunk_freqs)
+            picked_idx, picked_freqs = np.unique(np.searchsorted(cum_freqs, targets, side='left'), return_counts=True)
+            in_chunk = picked_idx < len(rows)  # targets beyond this chunk are picked from the following chunks
+            vals += [rows[i][0] for i in picked_idx[in_chunk]]
+            freqs.append(picked_freqs[in_chunk])
+            targets = targets[targets > cum_freqs[-1]]
+            cum_freq = cum_freqs[-1]
+        return np.array(vals, dtype=object), np.concatenate(freqs)
+
+    def _to_typed_array(self, vals: np.ndarray, is_numeric_col: bool = False) -> np.ndarray:
+        # Converts the input object array into a numeric array if all its values are numbers. Otherwise, the values are kept as strings, sharing one object per distinct value. The values of a continuous variable stored in a numeric column (see _is_numeric_col) are converted into floats without inspecting them first, unless the column holds some text.
+        if is_numeric_col:
+            try:
+                return vals.astype(np.float64)
+            except (ValueError, TypeError):
+                pass
+        inferred_type = pd.api.types.infer_dtype(vals, skipna=False)
+        if inferred_type == 'integer':
+            return vals.astype(np.int64)
+        elif inferred_type in ('floating', 'mixed-integer-float'):
+            return vals.astype(np.float64)
+        elif inferred_type != 'string':
+            vals = np.array([str(x) for x in vals], dtype=object)
+        codes, uniques = pd.factorize(vals)
+        return uniques[codes]
+
+    def _is_numeric_col(self, table_name: str, var_name: str) -> bool:
+        # Returns True if the input variable is continuous and stored in a column with a numeric type affinity (e.g. REAL as created by load.make_table from the metadata), so that its values are compared and aggregated as numbers by the database
+        if (table_name, var_name) not in self._col_affinity_dict:
+            for row in self._get_conn().execute(f"PRAGMA table_info({table_name})").fetchall():
+                self._col_affinity_dict[(table_name, row[1])] = self._get_type_affinity(row[2])
+        return self._get_var_type(table_name, var_name) == 'CNT' and self._col_affinity_dict.get((table_name, var_name)) in ('INTEGER', 'REAL', 'NUMERIC')
+
+    def _get_type_affinity(self, decl_type: str) -> str:
+        # Returns the type affinity of a column with the input declared type as per the rules of SQLite
+        decl_type = decl_type.upper()
+        if 'INT' in decl_type:
+            return 'INTEGER'
+        elif any(text_type in decl_type for text_type in ('CHAR', 'CLOB', 'TEXT')):
+            return 'TEXT'
+        elif 'BLOB' in decl_type or decl_type == '':
+            return 'BLOB'
+        elif any(real_type in decl_type for real_type in ('REAL', 'FLOA', 'DOUB')):
+            return 'REAL'
+        return 'NUMERIC'
+
+    def _sample_vals(self, val_bag: Union[np.ndarray, pd.Series], size=None, min_val=None):
+        # Samples values from the input value bag. Distinct values are sampled in proportion to their counts. If min_val is provided, only values that are not smaller than min_val are sampled.
+        if isinstance(val_bag, pd.Series):
+            vals, freqs = val_bag.index.to_numpy(), val_bag.to_numpy(dtype=np.float64)
+        else:
+            vals, freqs = val_bag, None
+        if min_val is not None:
+            mask = vals >= min_val
+            vals = vals[mask]
+            freqs = freqs[mask] if freqs is not None else None
+        probs = freqs/freqs.sum() if freqs is not None else None
+        return self._get_rng().choice(vals, size=size, p=probs)
+
+    def _quote_val(self, var_type: str, val) -> str:
+        # Converts a value sampled from a value bag into an SQL literal. Categorical values, date strings and the placeholder of empty bags are quoted, while any quote inside the value is escaped.
+        if var_type == 'CAT' or (isinstance(val, str) and (var_type == 'DT' or val == 'N/A')):
+            return "'"+str(val).replace("'", "''")+"'"
+        return str(val)
+
+    def _get_val_bag(self, table_name: str, var_name: str) -> Union[np.ndarray, pd.Series]:
+        i = self._tbl_idx_dict[table_name]
         assert self._val_lst[i]['table_name'] == table_name, "Something wrong in table indexing!"
         return self._val_lst[i][var_name]
 
@@ -625,84 +878,246 @@ class RandomQuery():
 
     def _make_rnd_from_expr(self) -> str:
         # this function returns an expression joining a master parent (from_tbl) to multiple child, and parent to grandchild..etc
-        if self.fix_seed:
-            np.random.seed(self._seed_no)
-            random.seed(self._seed_no)
         if len(self._sole_name_lst) != 0:
             assert len(
                 self._sole_name_lst) == 1, "For tabular fuzzing, you can not have more than one table passed to the class."
+            self._compiled_terms = {'from_tbl': self._sole_name_lst[0], 'joins': []}
             return f" FROM {self._sole_name_lst[0]} ", self._sole_name_lst[0], []
         else:
             # randomly select master parent  (from_tbl)
-            parent1 = random.sample(self._parent_name_lst, 1)[0]
+            rng = self._get_rng()
+            parent1 = self._parent_name_lst[rng.integers(len(self._parent_name_lst))]
             # check the number of childs the master parent has
             child1_lst = self._get_tbl_childs(parent1)
             max_no_join_tbls = len(child1_lst)
             assert max_no_join_tbls >= 1, "Table {from_tbl} does not seem to have any child"
-            picked_no_join_tbls = min(random.randint(
-                1, max_no_join_tbls), self.no_join_tables)
+            picked_no_join_tbls = min(int(rng.integers(
+                1, max_no_join_tbls+1)), self.no_join_tables)
             join_expr = f" FROM {parent1} "
-            child1 = random.choice(child1_lst)  # pick only one child table
+            child1 = child1_lst[rng.integers(len(child1_lst))]  # pick only one child table
             parent = copy.deepcopy(parent1)
             child = copy.deepcopy(child1)
             join_tbl_lst = []
+            self._compiled_terms = {'from_tbl': parent1, 'joins': []}
             for i in range(picked_no_join_tbls):
                 join_tbl_lst.append(child)
                 this_on_expr = self._get_join_on_sub_expr(parent, child)
-                join_type = np.random.choice(
+                join_type = rng.choice(
                     list(self.oprtns['JOIN_TYPE'].keys()), p=list(self.oprtns['JOIN_TYPE'].values()))
+                self._compiled_terms['joins'].append((parent, child, str(join_type)))
                 join_expr += f" {join_type} {child} {this_on_expr}"
                 child2_lst = self._get_tbl_childs(child)
                 if len(child2_lst) != 0:  # in case there are grandchildren8
                     # make a choice between children and grandchildren
-                    child_lst = random.choice(child1_lst, child2_lst)
+                    child_lst = [child1_lst, child2_lst][rng.integers(2)]
                     if child_lst == child1_lst:  # picking children
                         parent = copy.deepcopy(parent1)
                         child1_lst.remove(child)
-                        child = random.choice(child1_lst)
+                        child = child1_lst[rng.integers(len(child1_lst))]
                     else:  # picking grandchildren
                         parent = copy.deepcopy(child1)
-                        child = random.choice(child2_lst)
+                        child = child2_lst[rng.integers(len(child2_lst))]
                 else:  # no grandchildren!
                     parent = copy.deepcopy(parent1)
                     # don't pick the same child twice!
                     child1_lst.remove(child)
                     if len(child1_lst) == 0:
                         break
-                    child = random.choice(child1_lst)
+                    child = child1_lst[rng.integers(len(child1_lst))]
             return join_expr, parent1, join_tbl_lst
 
-    def _make_query(self, query_exp: str) -> pd.DataFrame:
-        conn=sqlite3.connect(self._db_path)
-        with conn:
-            cur=conn.cursor()
-            res=cur.execute(query_exp)
-            query = res.fetchall()
-            query = pd.DataFrame(
-                query, columns=[description[0] for description in cur.description])
-            cur.close()
-        return query
+    def _make_query(self, query_exp: str, max_query_time=None) -> pd.DataFrame:
+        # Returns the result of the input query, read from the result cache if result_cache_dir is set and the result was cached before (see _fetch_query).
+        return self._make_sampled_query(query_exp, max_query_time)[0]
+
+    def _make_sampled_query(self, query_exp: str, max_query_time=None, sample_size: int = None, rng: np.random.Generator = None) -> Tuple[pd.DataFrame, int]:
+        # Same as _make_query but keeps a uniform random sample of at most sample_size rows of the result (drawn with rng) if sample_size is provided. Returns the (sampled) result and the number of rows of the whole result. A cached sample is reused as is.
+        if self.result_cache_dir is None:
+            return self._fetch_query(query_exp, max_query_time, sample_size, rng)
+        cache_path = self._get_result_cache_path(query_exp, sample_size)
+        if os.path.exists(cache_path):
+            try:
+                return pd.read_pickle(cache_path)
+            except (OSError, EOFError, pickle.UnpicklingError):  # e.g. a partially written file, so the query is executed again
+                pass
+        query, n_rows = self._fetch_query(query_exp, max_query_time, sample_size, rng)
+        tmp_path = f'{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        pd.to_pickle((query, n_rows), tmp_path)
+        os.replace(tmp_path, cache_path)  # atomic, so that concurrent workers never read a partial result
+        return query, n_rows
+
+    def _get_result_cache_path(self, query_exp: str, sample_size: int = None) -> str:
+        # Returns the path of the cached result of the input query. The key combines the normalized SQL, the sample size of the result, the fingerprints of the tables that it reads and the variable types used for fetching the results (see _to_col_chunk).
+        conn = self._get_conn()
+        data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+        norm_exp = ' '.join(query_exp.split())
+        db_tbl_names = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')").fetchall()]
+        query_tbl_names = sorted(tbl for tbl in db_tbl_names if re.search(rf'\b{re.escape(tbl)}\b', norm_exp))
+        os.makedirs(self.result_cache_dir, exist_ok=True)
+        key = repr((norm_exp, sample_size, [(tbl, self._get_tbl_fprint(conn, tbl, data_version)) for tbl in query_tbl_names], sorted(self._var_name_type_dict.items(), key=str)))
+        return os.path.join(self.result_cache_dir, 'query_'+hashlib.sha256(key.encode()).hexdigest()+'.pkl')
+
+    def _get_tbl_fprint(self, conn, tbl_name: str, data_version: int) -> str:
+        # Returns a fingerprint of the schema and content of the input table. It is kept in memory until the database changes (as indicated by PRAGMA data_version) and persisted in result_cache_dir under a cheap signature of the table (see _get_tbl_signature), so the table is streamed and hashed only if its signature was not seen before, e.g. once after any write to the database file.
+        cache_key = (tbl_name, id(conn))  # data_version is only comparable within the same connection
+        cached = self._tbl_fprint_cache.get(cache_key)
+        if cached is not None and cached[0] == data_version:
+            return cached[1]
+        fprint_path = os.path.join(self.result_cache_dir, 'fprint_'+hashlib.sha256(self._get_tbl_signature(conn, tbl_name).encode()).hexdigest()+'.txt')
+        try:
+            with open(fprint_path) as fprint_file:
+                fprint = fprint_file.read()
+        except OSError:
+            fprint = ''
+        if len(fprint) == 0:  # not persisted (or partially written), so the content is hashed
+            hasher = hashlib.sha256()
+            hasher.update(repr(conn.execute(f'PRAGMA table_info({tbl_name})').fetchall()).encode())
+            for chunk in pd.read_sql_query(f'SELECT * FROM {tbl_name}', conn, chunksize=self.fetch_chunk_size):
+                hasher.update(pd.util.hash_pandas_object(chunk, index=False).values.tobytes())
+            fprint = hasher.hexdigest()
+            tmp_path = f'{fprint_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w') as fprint_file:
+                fprint_file.write(fprint)
+            os.replace(tmp_path, fprint_path)  # atomic, so that concurrent workers never read a partial fingerprint
+        self._tbl_fprint_cache[cache_key] = (data_version, fprint)
+        return fprint
+
+    def _get_tbl_signature(self, conn, tbl_name: str) -> str:
+        # Returns a signature of the input table that is cheap to compute: the path, modification time and size of the database file (and of its write-ahead log), the schema version of the database, the columns of the table, its number of rows and its maximum rowid. Any write to the database changes the signature.
+        file_stats = []
+        for path in [self._db_path, f'{self._db_path}-wal']:
+            if os.path.exists(path):
+                path_stat = os.stat(path)
+                file_stats.append((path_stat.st_mtime_ns, path_stat.st_size))
+        schema_version = conn.execute('PRAGMA schema_version').fetchone()[0]
+        tbl_info = conn.execute(f'PRAGMA table_info({tbl_name})').fetchall()
+        try:
+            n_rows, max_rowid = conn.execute(f'SELECT COUNT(*), MAX(rowid) FROM {tbl_name}').fetchone()
+        except sqlite3.OperationalError:  # e.g. a view or a table without rowid
+            n_rows, max_rowid = conn.execute(f'SELECT COUNT(*) FROM {tbl_name}').fetchone()[0], None
+        return repr((os.path.abspath(self._db_path), file_stats, schema_version, tbl_name, tbl_info, n_rows, max_rowid))
+
+    def _fetch_query(self, query_exp: str, max_query_time=None, sample_size: int = None, rng: np.random.Generator = None) -> Tuple[pd.DataFrame, int]:
+        # Returns the result of the input query and its number of rows. If max_query_time (in seconds) is provided, the execution is aborted once the time is exceeded (see _query_deadline) and TimeoutError is raised. If sample_size is provided, only a reservoir sample of at most sample_size rows (in their result order) is kept while the rows are streamed, so the memory does not grow with the size of the result.
+        conn=self._get_conn()
+        with self._query_deadline(max_query_time):
+            return self._fetch_rows(conn, query_exp, max_query_time, sample_size, rng)
+
+    @contextlib.contextmanager
+    def _query_deadline(self, max_query_time=None):
+        # Applies a single deadline of max_query_time seconds from now to all the statements executed by the current thread within the scope, where the execution is aborted from within the connection by a progress handler once the deadline passes. A scope opened within another scope of the same thread keeps the outer deadline.
+        pool = self._conn_pool
+        if max_query_time is None or getattr(pool, 'deadline', None) is not None:
+            yield
+            return
+        conn = self._get_conn()
+        deadline = time.monotonic()+max_query_time
+        pool.deadline = deadline
+        conn.set_progress_handler(lambda: time.monotonic() > deadline, self.progress_check_steps) # a non-zero return interrupts the running statement
+        try:
+            yield
+        finally:
+            conn.set_progress_handler(None, 0)  # the connection is reused by the following queries
+            pool.deadline = None
+
+    def _fetch_rows(self, conn, query_exp: str, max_query_time, sample_size: int, rng: np.random.Generator) -> Tuple[pd.DataFrame, int]:
+        # Executes the input query and fetches its rows for _fetch_query under the deadline of the current thread, if any (see _query_deadline)
+        deadline = getattr(self._conn_pool, 'deadline', None)
+        try:
+            with conn:
+                cur=conn.cursor()
+                res=cur.execute(query_exp)
+                col_names = [description[0] for description in cur.description]
+                col_chunks = [[] for _ in col_names]
+                n_rows = 0
+                if sample_size is not None:
+                    reservoir = np.empty((sample_size, len(col_names)), dtype=object)
+                    reservoir_row_nos = np.empty(sample_size, dtype=np.int64)  # the row number of each sampled row in the result
+                while True:
+                    rows = res.fetchmany(self.fetch_chunk_size)
+                    if len(rows) == 0:
+                        break
+                    chunk = np.empty((len(rows), len(col_names)), dtype=object)
+                    chunk[:] = rows  # the row tuples are released with the rows list
+                    del rows
+                    if sample_size is not None:
+                        self._update_reservoir(reservoir, reservoir_row_nos, chunk, n_rows, rng)
+                    else:
+                        for j, col_name in enumerate(col_names):
+                            col_chunks[j].append(self._to_col_chunk(col_name, chunk[:, j]))
+                    n_rows += len(chunk)
+                cur.close()
+            if sample_size is not None and n_rows != 0:
+                chunk = reservoir[np.argsort(reservoir_row_nos[:min(n_rows, sample_size)])]
+                for j, col_name in enumerate(col_names):
+                    col_chunks[j].append(self._to_col_chunk(col_name, chunk[:, j]))
+            query = pd.DataFrame({j: self._concat_col_chunks(col_names[j], chunks) for j, chunks in enumerate(col_chunks)})
+            query.columns = col_names  # the names may be repeated (e.g. the join keys of 'SELECT *')
+        except sqlite3.OperationalError as err:
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"Query execution exceeded {max_query_time} seconds: {query_exp}") from err
+            raise
+        return query, n_rows
+
+    def _update_reservoir(self, reservoir: np.ndarray, reservoir_row_nos: np.ndarray, chunk: np.ndarray, n_rows: int, rng: np.random.Generator):
+        # Updates the reservoir sample of the rows streamed so far (n_rows) with the next chunk of rows as per Algorithm R, i.e. the row number i replaces a random slot of the reservoir with the probability of sample_size/(i+1). So the reservoir remains a uniform random sample of all the rows streamed.
+        sample_size = len(reservoir)
+        n_fill = min(max(sample_size-n_rows, 0), len(chunk))  # the free slots are filled first
+        reservoir[n_rows:n_rows+n_fill] = chunk[:n_fill]
+        reservoir_row_nos[n_rows:n_rows+n_fill] = np.arange(n_rows, n_rows+n_fill)
+        if n_fill == len(chunk):
+            return
+        row_nos = np.arange(n_rows+n_fill, n_rows+len(chunk))
+        slots = rng.integers(0, row_nos+1)
+        is_kept = slots < sample_size
+        row_nos, slots = row_nos[is_kept][::-1], slots[is_kept][::-1]
+        slots, last_idx = np.unique(slots, return_index=True)  # a slot drawn more than once keeps the last row
+        reservoir[slots] = chunk[row_nos[last_idx]-n_rows]
+        reservoir_row_nos[slots] = row_nos[last_idx]
+
+    def _to_col_chunk(self, col_name: str, col_vals: np.ndarray) -> np.ndarray:
+        # Converts the object values of a fetched chunk of a result column into a typed array. Columns named after CNT variables go into float64 buffers (with NULL as NaN), while any other column (or a CNT column holding non-numeric values) is kept as objects.
+        if self._var_name_type_dict.get(col_name) == 'CNT':
+            try:
+                return col_vals.astype(np.float64)
+            except (ValueError, TypeError):
+                pass
+        return col_vals.copy()  # do not keep the whole chunk alive through a view
+
+    def _concat_col_chunks(self, col_name: str, chunks: list) -> pd.Series:
+        # Joins the fetched chunks of a result column into one series. Object columns are converted to the dtype that pandas would infer from the values (e.g. COUNT(*) into int64).
+        if len(chunks) == 0:
+            return pd.Series(np.array([], dtype=np.float64 if self._var_name_type_dict.get(col_name) == 'CNT' else object))
+        col_arr = chunks[0] if len(chunks) == 1 else np.concatenate(chunks)
+        col = pd.Series(col_arr, copy=False)
+        return col.infer_objects() if col_arr.dtype == object else col
+
+    def _get_tbl_shape(self, conn, tbl_name) -> tuple:
+        # Returns the shape and variable names of the input table from the database without reading the table itself
+        var_names = [row[1] for row in conn.execute(f"PRAGMA table_info({tbl_name})").fetchall()]
+        if len(var_names) == 0:
+            raise Exception(f"Table {tbl_name} does not exist in database!")
+        n_rows = conn.execute(f"SELECT COUNT(*) FROM {tbl_name}").fetchone()[0]
+        return (n_rows, len(var_names)), var_names
 
     def _validate_syn_lst(self, syn_tbl_name_lst):
-        conn=sqlite3.connect(self._db_path)
-        with conn:
-            assert len(syn_tbl_name_lst) == len(
-                self._tbl_name_lst), "The number of the synthetic data tables does not match the number of the real data tables!"
-            # self._syn_tbl_lst=[] #SMK NOTE: You can comment out this line and the commented one  below if you want to keep synthetic data in memory as frames
-            for i, (real_name, syn_name) in enumerate(zip(self._tbl_name_lst, syn_tbl_name_lst)):
-                real = self._tbl_lst[i]
-                try:
-                    syn = pd.read_sql_query(f'SELECT * FROM {syn_name}', conn)
-                    assert real.shape == syn.shape, f"The synesthetic table {syn_name} does not have the same shape of the real table {real_name}! Please make sure that the real and synthetic lists are ordered properly."
-                    # self._syn_tbl_lst.append(syn)
-                except:
+        # The validation result is cached and redone only if the database changes (as indicated by PRAGMA data_version) or a different list of synthetic tables is passed
+        assert len(syn_tbl_name_lst) == len(
+            self._tbl_name_lst), "The number of the synthetic data tables does not match the number of the real data tables!"
+        conn=self._get_conn()
+        data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+        cache_key = (tuple(syn_tbl_name_lst), id(conn))  # data_version is only comparable within the same connection
+        if self._syn_valid_cache.get(cache_key) != data_version:
+            for real_name, syn_name in zip(self._tbl_name_lst, syn_tbl_name_lst):
+                real_shape, real_vars = self._get_tbl_shape(conn, real_name)
+                syn_shape, syn_vars = self._get_tbl_shape(conn, syn_name)
+                if real_shape != syn_shape:
                     raise Exception(
-                        f"Table {syn_name} does not exist in database!")
-                try:
-                    assert list(real.columns).sort() == list(syn.columns).sort()
-                except:
+                        f"The synesthetic table {syn_name} does not have the same shape of the real table {real_name}! Please make sure that the real and synthetic lists are ordered properly.")
+                if sorted(real_vars) != sorted(syn_vars):
                     raise Exception(
                         f"Table {syn_name} and {real_name} do not have identical variable names!")
+            self._syn_valid_cache[cache_key] = data_version
 
         self._syn_tbl_name_lst = syn_tbl_name_lst
 
@@ -724,12 +1139,6 @@ class RandomQuery():
         # returns randomly picked cat vars including the concatenated table name of the real data (ie that is defined in the class)
         # Note: You can group by CAT_VARS and DT_VARS whether from parent or child or both
         join_tbl_lst = copy.deepcopy(inp_join_tbl_lst)
-        if self.fix_seed:
-            np.random.seed(self._seed_no)
-            random.seed(self._seed_no)
-            seed = self._seed_no
-        else:
-            seed = None
         all_catdt_vars = []
         # if len(join_tbl_lst) != 0:
         # possible group-by list includes only from_tbl and join_tbl lists
@@ -756,19 +1165,18 @@ class RandomQuery():
 
         custom_rv = self._make_int_rv(
             len(all_catdt_vars)+1, dist='favor_small')
-        selected_n_vars = custom_rv.rvs(1, random_state=seed)
+        rng = self._get_rng()
+        selected_n_vars = custom_rv.rvs(1, random_state=rng)
         #selected_n_vars=selected_n_vars if self.no_groupby_vars==np.nan else min(len(all_catdt_vars),self.no_groupby_vars)
-        selected_n_vars = min(random.randint(
-            1, len(all_catdt_vars)), self.no_groupby_vars)
-        picked_vars = random.sample(all_catdt_vars, selected_n_vars)
-        picked_vars = list(set(picked_vars))
+        selected_n_vars = min(int(rng.integers(
+            1, len(all_catdt_vars)+1)), self.no_groupby_vars)
+        picked_vars = [all_catdt_vars[i] for i in rng.choice(len(all_catdt_vars), size=selected_n_vars, replace=False)]
+        picked_vars = list(dict.fromkeys(picked_vars))
+        self._compiled_terms['groupby_lst'] = picked_vars
         return picked_vars
 
     def _get_rnd_agg_fntn_terms(self, from_tbl, inp_join_tbl_lst) -> tuple:
         join_tbl_lst = copy.deepcopy(inp_join_tbl_lst)
-        if self.fix_seed:
-            np.random.seed(self._seed_no)
-            random.seed(self._seed_no)
         all_cnt_vars = []
         # if len(join_tbl_lst) != 0:
         # possible list for agg_fntn operand includes only from_tbl and join_tbl lists
@@ -788,16 +1196,19 @@ class RandomQuery():
         #assert len( all_cnt_vars)!=0, "No continuous variable is available to use it with an Aggregate Function. Please set agg_fnt to False."
         all_cnt_vars = [
             var for vars in all_cnt_vars for var in vars]  # flatten
-        picked_cnt_var = np.random.choice(all_cnt_vars)
-        picked_log_op = np.random.choice(
+        rng = self._get_rng()
+        picked_cnt_var = rng.choice(all_cnt_vars)
+        picked_log_op = rng.choice(
             list(self.oprtns['AGG_OPS'].keys()), p=list(self.oprtns['AGG_OPS'].values()))
         return picked_log_op, picked_cnt_var
 
     def compile_agg_expr(self) -> Tuple[str, list, str, list, tuple]:
-        """ Generates random aggregate query expression.
+        """ Generates random aggregate query expression. If est_rows_window or est_max_cost is set, the expression is resampled until its estimates fall within them.
 
         """
+        return self._resample_expr(self._compile_agg_expr)
 
+    def _compile_agg_expr(self) -> Tuple[str, list, str, list, tuple]:
         # from table is the table right after the from clause which can be either a sole or parent table
         from_expr, from_table, join_tbl_lst = self._make_rnd_from_expr()
         groupby_lst = self._get_rnd_groupby_lst(
@@ -846,9 +1257,13 @@ class RandomQuery():
         }
         return dic
 
-    def make_twin_agg_query(self, syn_tbl_name_lst: list, real_expr: str, real_groupby_lst: list, real_from_tbl: str, real_join_tbl_lst: list, agg_fntn_terms: tuple) -> dict:
+    def make_twin_agg_query(self, syn_tbl_name_lst: list, real_expr: str, real_groupby_lst: list, real_from_tbl: str, real_join_tbl_lst: list, agg_fntn_terms: tuple, max_query_time=None, real_twin: dict = None) -> dict:
         """ Executes a twin (both for real and synthetic datasets) aggregate query expression and returns the results as dataframes in a dictionary
 
+        Args:
+            max_query_time: The maximum time in seconds that is allowed to execute each of the real and synthetic queries. TimeoutError is raised if exceeded. The default None does not limit the execution time.
+            real_twin: An optional twin query dictionary returned by an earlier call for the same real expression (e.g. against another set of synthetic tables). If provided, its real-side results are reused and only the synthetic query is executed. It is ignored if twin_single_pass is set.
+
         """
 
         self._validate_syn_lst(syn_tbl_name_lst)  # validate syn list
@@ -867,8 +1282,15 @@ class RandomQuery():
         else:
             syn_join_tbl_lst = []
 
-        query_real = self._make_query(real_expr)
-        query_syn = self._make_query(syn_expr)
+        if self.twin_single_pass:
+            grpby_col_names = [var.split('.')[-1] for var in real_groupby_lst]  # as named by sqlite
+            query_real, query_syn, n_rows_real, n_rows_syn = self._make_single_pass_agg_query(real_expr, syn_expr, grpby_col_names, agg_fntn_terms, max_query_time)
+        else:
+            if real_twin is not None:
+                query_real, query_syn = real_twin['query_real'], self._make_query(syn_expr, max_query_time)
+            else:
+                query_real, query_syn = self._run_twin(lambda: self._make_query(real_expr, max_query_time), lambda: self._make_query(syn_expr, max_query_time))
+            n_rows_real, n_rows_syn = query_real.shape[0], query_syn.shape[0]
         # grpby_vars=self._drop_tbl_name(real_grp_lst)
         dic = {}
         dic['query_real'] = query_real
@@ -881,31 +1303,50 @@ class RandomQuery():
             "join_tbl_name_lst_real": real_join_tbl_lst,
             "sql_real": real_expr,
             "n_cols_real": query_real.shape[1],
-            "n_rows_real": query_real.shape[0],
+            "n_rows_real": n_rows_real,
             "from_tbl_name_syn": syn_from_tbl,
             "join_tbl_name_lst_syn": syn_join_tbl_lst,
             "sql_syn": syn_expr,
             "n_cols_syn": query_syn.shape[1],
-            "n_rows_syn": query_syn.shape[0],
+            "n_rows_syn": n_rows_syn,
+            "is_matched": self.twin_single_pass,
         }
         return dic
 
+    def _make_single_pass_agg_query(self, real_expr: str, syn_expr: str, grpby_col_names: list, agg_fntn_terms: tuple, max_query_time=None) -> Tuple[pd.DataFrame, pd.DataFrame, int, int]:
+        # Executes the real and synthetic aggregate expressions as one compound statement. Both are wrapped in CTEs with positional column names, stacked by UNION ALL with a source tag and regrouped by the group-by keys, so that each group gets its real and synthetic counts (and aggregates) in the same row. Groups missing from either query get zero count and aggregate as in _match_queries4agg. Returns the matched real and synthetic results (named like the real query) and the number of groups returned by each of the queries.
+        key_cols = [f'_k{j}' for j in range(len(grpby_col_names))]
+        val_cols = ['_cnt'] if agg_fntn_terms[0] == 'None' else ['_cnt', '_agg']
+        cte_cols = ', '.join(key_cols+val_cols)
+        val_exprs = []
+        for src in (0, 1):  # real, syn
+            val_exprs.append(f'SUM(CASE WHEN _src={src} THEN _cnt ELSE 0 END)')
+            if len(val_cols) == 2:  # a group has at most one row per source, so MAX picks its aggregate while keeping NULLs
+                val_exprs.append(f'CASE WHEN SUM(_src={src})>0 THEN MAX(CASE WHEN _src={src} THEN _agg END) ELSE 0 END')
+        compound_expr = f'WITH _real_q({cte_cols}) AS ({real_expr}), _syn_q({cte_cols}) AS ({syn_expr}) ' + \
+            f'SELECT {", ".join(key_cols+val_exprs)} FROM (SELECT 0 AS _src, * FROM _real_q UNION ALL SELECT 1 AS _src, * FROM _syn_q) ' + \
+            f'GROUP BY {", ".join(key_cols)}'
+        query = self._make_query(compound_expr, max_query_time)
+        col_names = grpby_col_names+['COUNT(*)'] + ([] if agg_fntn_terms[0] == 'None' else [f'{agg_fntn_terms[0]}({agg_fntn_terms[1]})'])
+        n_keys, n_vals = len(key_cols), len(val_cols)
+        query_real = query.iloc[:, list(range(n_keys+n_vals))]
+        query_syn = query.iloc[:, list(range(n_keys))+list(range(n_keys+n_vals, n_keys+2*n_vals))]
+        query_real.columns = col_names
+        query_syn.columns = col_names
+        return query_real, query_syn, int((query_real['COUNT(*)'] > 0).sum()), int((query_syn['COUNT(*)'] > 0).sum())
+
 
 ##################################### METHODS FOR GENERATING RANDOM FILTER QUERIES #############################
 
 
     def _get_tbl_val_dict(self, tbl_name) -> tuple:
         # Thi will return a tuple of the input dictionary name and its corresponding var-val dictionary. You can get the list of all values by checking the dictionary keys.
-        for tbl_val_dic in self._val_lst:
-            val_dict = copy.deepcopy(tbl_val_dic)
-            if tbl_val_dic['table_name'] == tbl_name:
-                del val_dict['table_name']
-                return (tbl_name, val_dict)
+        tbl_val_dic = self._val_lst[self._tbl_idx_dict[tbl_name]]
+        val_dict = {var_name: val_bag for var_name, val_bag in tbl_val_dic.items() if var_name != 'table_name'}
+        return (tbl_name, val_dict)
 
     def _get_tbl_var_tpl_lst(self, tbl_name):
-        for tbl_metdata in self._metadata_lst:
-            if tbl_metdata['table_name'] == tbl_name:
-                return [(tbl_name, var_tpl[0]) for var_tpl in tbl_metdata['table_vars']]
+        return list(self._tbl_var_tpls_dict[tbl_name])
 
     def _get_tbl_key_tpl(self, tbl_name):
         keys = self._get_table_keys(tbl_name)
@@ -913,12 +1354,6 @@ class RandomQuery():
 
     def _get_rnd_where_expr(self, from_tbl, join_tbl_lst, drop_fkey):
         # use WHERE with mix of CAT, CNT, DT variables from both PARENT and CHILD
-        if self.fix_seed:
-            np.random.seed(self._seed_no)
-            random.seed(self._seed_no)
-            seed = self._seed_no
-        else:
-            seed = None
         all_tbl_vars = self._get_tbl_var_tpl_lst(from_tbl)
         for join_tbl_name in join_tbl_lst:
             all_tbl_vars += self._get_tbl_var_tpl_lst(join_tbl_name)
@@ -933,15 +1368,17 @@ class RandomQuery():
             all_tbl_vars = self._remove_sublst(all_tbl_vars, all_tbl_keys)
 
         custom_rv = self._make_int_rv(len(all_tbl_vars)+1, dist='favor_small')
-        selected_n_vars = custom_rv.rvs(1, random_state=seed)
+        rng = self._get_rng()
+        selected_n_vars = custom_rv.rvs(1, random_state=rng)
         # selected_n_vars=selected_n_vars if self.no_where_vars==np.nan else min(len(all_tbl_vars),self.no_where_vars)
-        selected_n_vars = min(random.randint(
-            1, len(all_tbl_vars)), self.no_where_vars)
-        picked_vars = random.sample(all_tbl_vars, selected_n_vars)
+        selected_n_vars = min(int(rng.integers(
+            1, len(all_tbl_vars)+1)), self.no_where_vars)
+        picked_vars = [all_tbl_vars[i] for i in rng.choice(len(all_tbl_vars), size=selected_n_vars, replace=False)]
 
         # Get the correct operations and values for the the picked variables
         terms = ""
         log_ops = []
+        where_terms = []  # the structured terms for estimate_last_expr
         for idx, (tbl_name, var_name) in enumerate(picked_vars):
             var_type = self._get_var_type(tbl_name, var_name)
             val_bag = self._get_val_bag(tbl_name, var_name)
@@ -949,28 +1386,21 @@ class RandomQuery():
                 val_bag) != 0, f"Variable {var_name} in table {tbl_name} does not have enough values to sample from!"
 
             # adding NOT modifier to variable name
-            not_status = np.random.choice(
+            not_status = self._get_rng().choice(
                 list(self.oprtns['NOT_STATE'].keys()), p=list(self.oprtns['NOT_STATE'].values()))
             not_modifier = 'NOT ' if not_status == '1' else ""
 
             if var_type == 'CAT':
-                var_op = np.random.choice(
+                var_op = self._get_rng().choice(
                     list(self.oprtns['CAT_OPS'].keys()), p=list(self.oprtns['CAT_OPS'].values()))
                 if var_op == 'IN' or var_op == 'NOT IN':
-                    no_in_terms = random.randint(
-                        2, len(val_bag)) if len(val_bag) > 2 else 2
+                    no_in_terms = int(rng.integers(
+                        2, len(val_bag)+1)) if len(val_bag) > 2 else 2
                     no_in_terms = min(no_in_terms, self.max_in_terms)
-                    vals = np.random.choice(val_bag, size=no_in_terms)
-                    # This will eliminate double quotes in the list of values used in the IN clause
-                    for i, x in enumerate(vals):
-                        try:
-                            vals[i] = eval(x)
-                        except:
-                            continue
-                    vals = set(vals)
-                    vals_str = f"{vals}"
-                    vals_str = vals_str.replace("}", ")")
-                    vals_str = vals_str.replace("{", "(")
+                    vals = self._sample_vals(val_bag, size=no_in_terms)
+                    # drop duplicates while keeping the order of values stable across processes
+                    raw_vals = list(dict.fromkeys(vals.tolist()))
+                    vals_str = "("+", ".join([self._quote_val(var_type, x) for x in raw_vals])+")"
                     if var_op == 'IN':
                         term = f" {not_modifier} {tbl_name}.{var_name} IN "+vals_str + " " if len(
                             join_tbl_lst) != 0 else f" {not_modifier} {var_name} IN "+vals_str + " "
@@ -978,17 +1408,19 @@ class RandomQuery():
                         term = f" {not_modifier} {tbl_name}.{var_name} NOT IN "+vals_str + " " if len(
                             join_tbl_lst) != 0 else f" {not_modifier} {var_name} NOT IN "+vals_str + " "
                 else:
-                    val = np.random.choice(val_bag)
+                    raw_vals = [self._sample_vals(val_bag)]
+                    val = self._quote_val(var_type, raw_vals[0])
                     term = f" {not_modifier} {tbl_name}.{var_name} {var_op} {val} " if len(
                         join_tbl_lst) != 0 else f" {not_modifier} {var_name} {var_op} {val} "
 
             elif var_type == 'CNT':
-                var_op = np.random.choice(
+                var_op = self._get_rng().choice(
                     list(self.oprtns['CNT_OPS'].keys()), p=list(self.oprtns['CNT_OPS'].values()))
                 if var_op == 'BETWEEN' or var_op == 'NOT BETWEEN':
-                    lower_bound = np.random.choice(val_bag)
-                    upper_bound_bag = [x for x in val_bag if x >= lower_bound]
-                    upper_bound = np.random.choice(upper_bound_bag)
+                    lower_bound = self._sample_vals(val_bag)
+                    upper_bound = self._sample_vals(val_bag, min_val=lower_bound)
+                    raw_vals = [lower_bound, upper_bound]
+                    lower_bound, upper_bound = self._quote_val(var_type, lower_bound), self._quote_val(var_type, upper_bound)
                     if var_op == 'BETWEEN':
                         term = f" {not_modifier} {tbl_name}.{var_name} BETWEEN {lower_bound} AND {upper_bound} " if len(
                             join_tbl_lst) != 0 else f" {not_modifier} {var_name} BETWEEN {lower_bound} AND {upper_bound} "
@@ -996,17 +1428,19 @@ class RandomQuery():
                         term = f" {not_modifier} {tbl_name}.{var_name} NOT BETWEEN {lower_bound} AND {upper_bound} " if len(
                             join_tbl_lst) != 0 else f" {not_modifier} {var_name} NOT BETWEEN {lower_bound} AND {upper_bound} "
                 else:
-                    val = np.random.choice(val_bag)
+                    raw_vals = [self._sample_vals(val_bag)]
+                    val = self._quote_val(var_type, raw_vals[0])
                     term = f" {not_modifier} {tbl_name}.{var_name} {var_op} {val} " if len(
                         join_tbl_lst) != 0 else f" {not_modifier} {var_name} {var_op} {val} "
 
             elif var_type == 'DT':
-                var_op = np.random.choice(
+                var_op = self._get_rng().choice(
                     list(self.oprtns['DT_OPS'].keys()), p=list(self.oprtns['DT_OPS'].values()))
                 if var_op == 'BETWEEN' or var_op == 'NOT BETWEEN':
-                    lower_bound = np.random.choice(val_bag)
-                    upper_bound_bag = [x for x in val_bag if x >= lower_bound]
-                    upper_bound = np.random.choice(upper_bound_bag)
+                    lower_bound = self._sample_vals(val_bag)
+                    upper_bound = self._sample_vals(val_bag, min_val=lower_bound)
+                    raw_vals = [lower_bound, upper_bound]
+                    lower_bound, upper_bound = self._quote_val(var_type, lower_bound), self._quote_val(var_type, upper_bound)
                     if var_op == 'BETWEEN':
                         term = f" {not_modifier} {tbl_name}.{var_name} BETWEEN {lower_bound} AND {upper_bound} " if len(
                             join_tbl_lst) != 0 else f" {not_modifier} {var_name} BETWEEN {lower_bound} AND {upper_bound} "
@@ -1014,20 +1448,13 @@ class RandomQuery():
                         term = f" {not_modifier} {tbl_name}.{var_name} NOT BETWEEN {lower_bound} AND {upper_bound} " if len(
                             join_tbl_lst) != 0 else f" {not_modifier} {var_name} NOT BETWEEN {lower_bound} AND {upper_bound} "
                 elif var_op == 'IN' or var_op == 'NOT IN':
-                    no_in_terms = random.randint(
-                        2, len(val_bag)) if len(val_bag) > 2 else 2
+                    no_in_terms = int(rng.integers(
+                        2, len(val_bag)+1)) if len(val_bag) > 2 else 2
                     no_in_terms = min(no_in_terms, self.max_in_terms)
-                    vals = np.random.choice(val_bag, size=no_in_terms)
-                    # This will eliminate double quotes in the list of values used in the IN clause
-                    for i, x in enumerate(vals):
-                        try:
-                            vals[i] = eval(x)
-                        except:
-                            continue
-                    vals = set(vals)
-                    vals_str = f"{vals}"
-                    vals_str = vals_str.replace("}", ")")
-                    vals_str = vals_str.replace("{", "(")
+                    vals = self._sample_vals(val_bag, size=no_in_terms)
+                    # drop duplicates while keeping the order of values stable across processes
+                    raw_vals = list(dict.fromkeys(vals.tolist()))
+                    vals_str = "("+", ".join([self._quote_val(var_type, x) for x in raw_vals])+")"
                     if var_op == 'IN':
                         term = f" {not_modifier} {tbl_name}.{var_name} IN "+vals_str + " " if len(
                             join_tbl_lst) != 0 else f" {not_modifier} {var_name} IN "+vals_str + " "
@@ -1035,7 +1462,8 @@ class RandomQuery():
                         term = f" {not_modifier} {tbl_name}.{var_name} NOT IN "+vals_str + " " if len(
                             join_tbl_lst) != 0 else f" {not_modifier} {var_name} NOT IN "+vals_str + " "
                 else:
-                    val = np.random.choice(val_bag)
+                    raw_vals = [self._sample_vals(val_bag)]
+                    val = self._quote_val(var_type, raw_vals[0])
                     term = f" {not_modifier} {tbl_name}.{var_name} {var_op} {val} " if len(
                         join_tbl_lst) != 0 else f" {not_modifier} {var_name} {var_op} {val} "
             else:
@@ -1043,25 +1471,33 @@ class RandomQuery():
                     f"Can not find {var_name} in the lists of all variables!!")
 
             terms += term
+            where_terms.append({'tbl_name': tbl_name, 'var_name': var_name, 'op': str(var_op), 'vals': raw_vals, 'is_not': not_status == '1'})
             if idx < len(picked_vars)-1:
-                selected_logic_op = np.random.choice(
+                selected_logic_op = self._get_rng().choice(
                     list(self.oprtns['LOGIC_OPS'].keys()),  p=list(self.oprtns['LOGIC_OPS'].values()))
                 terms += selected_logic_op
+                log_ops.append(str(selected_logic_op))
 
+        self._compiled_terms['where_terms'] = where_terms
+        self._compiled_terms['logic_ops'] = log_ops
         return terms
 
     def compile_fltr_expr(self) -> Tuple[str, str, list]:
-        """ Generates random filter query expression.
+        """ Generates random filter query expression. If est_rows_window or est_max_cost is set, the expression is resampled until its estimates fall within them.
 
         """
+        return self._resample_expr(self._compile_fltr_expr)
+
+    def _compile_fltr_expr(self) -> Tuple[str, str, list]:
         from_expr, from_tbl, join_tbl_lst = self._make_rnd_from_expr()
         where_expr = self._get_rnd_where_expr(
             from_tbl, join_tbl_lst, drop_fkey=True)
         if len(join_tbl_lst) != 0:
-            fltr_type = np.random.choice(list(self.oprtns['FILTER_TYPE'].keys()), p=list(
+            fltr_type = self._get_rng().choice(list(self.oprtns['FILTER_TYPE'].keys()), p=list(
                 self.oprtns['FILTER_TYPE'].values()))
         else:
             fltr_type = 'WHERE'
+        self._compiled_terms['fltr_type'] = str(fltr_type)
         expr = 'SELECT * ' + from_expr + f' {fltr_type} ' + where_expr
         return expr, from_tbl, join_tbl_lst
 
@@ -1085,21 +1521,49 @@ class RandomQuery():
         }
         return dic
 
-    def make_twin_fltr_query(self, syn_tbl_name_lst: list, real_expr: str, real_from_tbl: str, real_join_tbl_lst: list) -> dict:
+    def make_twin_fltr_query(self, syn_tbl_name_lst: list, real_expr: str, real_from_tbl: str, real_join_tbl_lst: list, max_query_time=None, real_twin: dict = None) -> dict:
         """ Executes a twin filter query expression and returns the results as dataframes in a dictionary
 
+        Args:
+            max_query_time: The maximum time in seconds that is allowed to execute each of the real and synthetic queries. TimeoutError is raised if exceeded. The default None does not limit the execution time.
+            real_twin: An optional twin query dictionary returned by an earlier call for the same real expression (e.g. against another set of synthetic tables). If provided, its real-side results are reused and only the synthetic query is executed.
+
         """
 
         self._validate_syn_lst(syn_tbl_name_lst)  # validate syn list
-        real_expr,real_from_tbl, real_join_tbl_lst =self.compile_fltr_expr()
+        # real_expr,real_from_tbl, real_join_tbl_lst =self.compile_fltr_expr()
         # print(real_expr) #SMK TMP
         syn_expr = self._expr_replace_tbl_name(real_expr)
         syn_from_tbl = syn_tbl_name_lst[self._get_tbl_index(real_from_tbl)]
         syn_join_tbl_lst = [syn_tbl_name_lst[self._get_tbl_index(
             real_tbl_name)] for real_tbl_name in real_join_tbl_lst]
-        query_real = self._make_query(real_expr)
-        query_syn = self._make_query(syn_expr)
         dic = {}
+        sample_size = self.hlngr_sample_size  # the results are sampled for estimating the Hellinger distances
+        real_rng, syn_rng = (self._spawn_rng(), self._spawn_rng()) if sample_size is not None else (None, None)
+        if real_twin is not None:
+            query_real, n_rows_real = real_twin['query_real'], real_twin['query_desc']['n_rows_real']
+            if 'cat_counts_real' in real_twin:  # made in pushdown mode
+                dic['cat_counts_real'] = real_twin['cat_counts_real']
+                query_syn, dic['cat_counts_syn'] = self._make_pushdown_fltr_query(real_expr, real_from_tbl, real_join_tbl_lst, True, max_query_time)
+                n_rows_syn = len(query_syn)
+                query_syn = self._sample_rows4hlngr(query_syn, syn_rng) if sample_size is not None else query_syn
+            else:
+                query_syn, n_rows_syn = self._make_sampled_query(syn_expr, max_query_time, sample_size, syn_rng)
+            n_cols_real, n_cols_syn = real_twin['query_desc']['n_cols_real'], real_twin['query_desc']['n_cols_syn']
+        elif self.hlngr_pushdown:
+            (query_real, dic['cat_counts_real']), (query_syn, dic['cat_counts_syn']) = self._run_twin(
+                lambda: self._make_pushdown_fltr_query(real_expr, real_from_tbl, real_join_tbl_lst, False, max_query_time),
+                lambda: self._make_pushdown_fltr_query(real_expr, real_from_tbl, real_join_tbl_lst, True, max_query_time))
+            n_rows_real, n_rows_syn = len(query_real), len(query_syn)
+            if sample_size is not None:  # only the non-CAT variables are fetched in pushdown mode, so they are sampled after the fetch
+                query_real, query_syn = self._sample_rows4hlngr(query_real, real_rng), self._sample_rows4hlngr(query_syn, syn_rng)
+            n_cols = sum(len(self._get_tbl_var_tpl_lst(tbl)) for tbl in [real_from_tbl]+real_join_tbl_lst)  # the number of columns of 'SELECT *'
+            n_cols_real, n_cols_syn = n_cols, n_cols
+        else:
+            (query_real, n_rows_real), (query_syn, n_rows_syn) = self._run_twin(
+                lambda: self._make_sampled_query(real_expr, max_query_time, sample_size, real_rng),
+                lambda: self._make_sampled_query(syn_expr, max_query_time, sample_size, syn_rng))
+            n_cols_real, n_cols_syn = query_real.shape[1], query_syn.shape[1]
         dic['query_real'] = query_real
         dic['query_syn'] = query_syn
         dic['query_desc'] = {
@@ -1107,25 +1571,55 @@ class RandomQuery():
             "from_tbl_name_real": real_from_tbl,
             "join_tbl_name_lst_real": real_join_tbl_lst,
             "sql_real": real_expr,
-            "n_cols_real": query_real.shape[1],
-            "n_rows_real": query_real.shape[0],
+            "n_cols_real": n_cols_real,
+            "n_rows_real": n_rows_real,
             "from_tbl_name_syn": syn_from_tbl,
             "join_tbl_name_lst_syn": syn_join_tbl_lst,
             "sql_syn": syn_expr,
-            "n_cols_syn": query_syn.shape[1],
-            "n_rows_syn": query_syn.shape[0],
+            "n_cols_syn": n_cols_syn,
+            "n_rows_syn": n_rows_syn,
         }
         return dic
 
+    def _make_pushdown_fltr_query(self, real_expr: str, real_from_tbl: str, real_join_tbl_lst: list, is_syn: bool, max_query_time=None) -> Tuple[pd.DataFrame, dict]:
+        # Executes the 'SELECT *' filter expression of the real tables (or of the synthetic ones if is_syn) in pushdown mode. Returns a dataframe of the non-CAT variables only and a dictionary mapping each (real table name, var name) of the CAT variables to its category counts computed in the database. Variables whose names are repeated across the joined tables (e.g. the join keys) are neither fetched nor counted since they are not scored.
+        var_tpls = [var_tpl for tbl in [real_from_tbl]+real_join_tbl_lst for var_tpl in self._get_tbl_var_tpl_lst(tbl)]
+        var_names = [var_tpl[1] for var_tpl in var_tpls]
+        var_tpls = [var_tpl for var_tpl in var_tpls if var_names.count(var_tpl[1]) == 1]
+        to_expr = self._expr_replace_tbl_name if is_syn else (lambda expr: expr)
+        fltr_body = real_expr[len('SELECT *'):]  # everything after the select list
+        return self._make_pushdown_query(fltr_body, var_tpls, [self._get_var_type(tbl, var) for tbl, var in var_tpls], to_expr, max_query_time)
+
+    def _make_pushdown_query(self, fltr_body: str, var_tpls: list, var_types: list, to_expr, max_query_time=None) -> Tuple[pd.DataFrame, dict]:
+        # Executes a 'SELECT var, COUNT(*) <fltr_body> GROUP BY 1' statement per CAT variable of var_tpls and a single 'SELECT <non-CAT vars> <fltr_body>' statement, where var_types gives the type of each variable of var_tpls, so that the row-level result of the CAT variables is never materialized. All the statements share a single deadline of max_query_time. The statements are built for the table names of var_tpls and passed through to_expr (e.g. to replace the real table names by the synthetic ones). Returns a dataframe of the non-CAT variables and a dictionary mapping each (table name, var name) of the CAT variables to its category counts, indexed by the categories where the NULL category is labeled 'NaN' (as in _calc_hlngr4cat).
+        cat_counts = {}
+        fetch_vars = []
+        with self._query_deadline(max_query_time):
+            for (tbl, var), var_type in zip(var_tpls, var_types):
+                if var_type == 'CAT':
+                    counts = self._make_query(to_expr(f'SELECT {tbl}.{var}, COUNT(*)'+fltr_body+' GROUP BY 1'), max_query_time)
+                    vals = ['NaN' if pd.isnull(val) else val for val in counts.iloc[:, 0]]
+                    cat_counts[(tbl, var)] = pd.Series(counts.iloc[:, 1].to_numpy(dtype=np.int64), index=vals, name=var)
+                else:
+                    fetch_vars.append(f'{tbl}.{var}')
+            if len(fetch_vars) != 0:
+                query = self._make_query(to_expr('SELECT '+', '.join(fetch_vars)+fltr_body), max_query_time)
+            else:  # nothing to fetch but the number of rows
+                n_rows = self._make_query(to_expr('SELECT COUNT(*)'+fltr_body), max_query_time).iloc[0, 0]
+                query = pd.DataFrame(index=range(n_rows))
+        return query, cat_counts
+
 
 ##################################### METHODS FOR GENERATING RANDOM FILTER-AGGREGATE QUERIES #############################
 
 
     def compile_aggfltr_expr(self) -> Tuple[str, list, str, list, tuple]:
-        """ Generates a random aggregate-filter query expression.
+        """ Generates a random aggregate-filter query expression. If est_rows_window or est_max_cost is set, the expression is resampled until its estimates fall within them.
 
         """
+        return self._resample_expr(self._compile_aggfltr_expr)
 
+    def _compile_aggfltr_expr(self) -> Tuple[str, list, str, list, tuple]:
         # from table is the table right after the from clause which can be either a sole or parent table
         from_expr, from_table, join_tbl_lst = self._make_rnd_from_expr()
         groupby_lst = self._get_rnd_groupby_lst(
@@ -1140,10 +1634,11 @@ class RandomQuery():
             from_table, join_tbl_lst, drop_fkey=True)
 
         if len(join_tbl_lst) != 0:
-            fltr_type = np.random.choice(list(self.oprtns['FILTER_TYPE'].keys()), p=list(
+            fltr_type = self._get_rng().choice(list(self.oprtns['FILTER_TYPE'].keys()), p=list(
                 self.oprtns['FILTER_TYPE'].values()))
         else:
             fltr_type = 'WHERE'
+        self._compiled_terms['fltr_type'] = str(fltr_type)
 
         log_op, cnt_var = self._get_rnd_agg_fntn_terms(
             from_table, join_tbl_lst)
@@ -1181,9 +1676,13 @@ class RandomQuery():
         }
         return dic
 
-    def make_twin_aggfltr_query(self, syn_tbl_name_lst: list, real_expr: str, real_groupby_lst: list, real_from_tbl: str, real_join_tbl_lst: list, agg_fntn_terms: tuple) -> dict:
+    def make_twin_aggfltr_query(self, syn_tbl_name_lst: list, real_expr: str, real_groupby_lst: list, real_from_tbl: str, real_join_tbl_lst: list, agg_fntn_terms: tuple, max_query_time=None, real_twin: dict = None) -> dict:
         """ Executes a twin aggregate-filter query expression and returns the results as dataframes in a dictionary
 
+        Args:
+            max_query_time: The maximum time in seconds that is allowed to execute each of the real and synthetic queries. TimeoutError is raised if exceeded. The default None does not limit the execution time.
+            real_twin: An optional twin query dictionary returned by an earlier call for the same real expression (e.g. against another set of synthetic tables). If provided, its real-side results are reused and only the synthetic query is executed. It is ignored if twin_single_pass is set.
+
         """
         
         self._validate_syn_lst(syn_tbl_name_lst)  # validate syn list
@@ -1203,15 +1702,21 @@ class RandomQuery():
         else:
             syn_join_tbl_lst = []
 
-        query_real = self._make_query(real_expr)
-        real_col_dic = dict(
-            zip(list(query_real.columns[0:len(real_groupby_lst)]), real_groupby_lst))
-        query_real.rename(columns=real_col_dic, inplace=True)
-        query_syn = self._make_query(syn_expr)
-        # No need to rename the table names to match these in the synthetic data since matching processes requires that both real and syn tables have same varibale names.
-        syn_col_dic = dict(
-            zip(list(query_syn.columns[0:len(real_groupby_lst)]), real_groupby_lst))
-        query_syn.rename(columns=syn_col_dic, inplace=True)
+        if self.twin_single_pass:
+            query_real, query_syn, n_rows_real, n_rows_syn = self._make_single_pass_agg_query(real_expr, syn_expr, real_groupby_lst, agg_fntn_terms, max_query_time)
+        else:
+            if real_twin is not None:
+                query_real, query_syn = real_twin['query_real'], self._make_query(syn_expr, max_query_time)
+            else:
+                query_real, query_syn = self._run_twin(lambda: self._make_query(real_expr, max_query_time), lambda: self._make_query(syn_expr, max_query_time))
+            real_col_dic = dict(
+                zip(list(query_real.columns[0:len(real_groupby_lst)]), real_groupby_lst))
+            query_real.rename(columns=real_col_dic, inplace=True)
+            # No need to rename the table names to match these in the synthetic data since matching processes requires that both real and syn tables have same varibale names.
+            syn_col_dic = dict(
+                zip(list(query_syn.columns[0:len(real_groupby_lst)]), real_groupby_lst))
+            query_syn.rename(columns=syn_col_dic, inplace=True)
+            n_rows_real, n_rows_syn = query_real.shape[0], query_syn.shape[0]
 
         dic = {}
 
@@ -1225,16 +1730,158 @@ class RandomQuery():
             "join_tbl_name_lst_real": real_join_tbl_lst,
             "sql_real": real_expr,
             "n_cols_real": query_real.shape[1],
-            "n_rows_real": query_real.shape[0],
+            "n_rows_real": n_rows_real,
             "from_tbl_name_syn": syn_from_tbl,
             "join_tbl_name_lst_syn": syn_join_tbl_lst,
             "sql_syn": syn_expr,
             "n_cols_syn": query_syn.shape[1],
-            "n_rows_syn": query_syn.shape[0],
+            "n_rows_syn": n_rows_syn,
+            "is_matched": self.twin_single_pass,
         }
 
         return dic
 
+    def make_syn_expr(self, syn_tbl_name_lst: list, real_expr: str) -> str:
+        """ Returns the twin of a query expression compiled for the real tables, i.e. the same expression against the synthetic tables, without executing either.
+
+        Args:
+            syn_tbl_name_lst: A list of the synthetic table names in the same order of the real tables of the object. The synthetic tables are validated against the real ones.
+            real_expr: The query expression of the real tables (e.g. as returned by compile_fltr_expr).
+
+        """
+        self._validate_syn_lst(syn_tbl_name_lst)
+        return self._expr_replace_tbl_name(real_expr)
+
+
+##################################### METHODS FOR ESTIMATING THE SIZE AND COST OF RANDOM QUERIES #############################
+
+
+    def estimate_last_expr(self) -> dict:
+        """ Estimates the size and cost of the last compiled query expression without executing it. The estimates are computed from per-variable statistics (value frequencies and distinct counts) of the value bags, the number of rows of the tables and the number of rows of each parent joined to each of its children (as per the parent_details of the metadata), where the filter terms are assumed to be independent. All the statistics are computed once and reused by the following estimates.
+
+        Returns:
+            A dictionary with the estimated number of rows returned by the expression ('n_rows'), i.e. the filtered rows of a filter expression or the groups of an aggregate expression, the estimated number of rows passing the filter ('n_fltr_rows') and the estimated cost in rows read and joined by the database ('cost').
+
+        """
+        assert len(self._compiled_terms) != 0, "No query expression has been compiled yet!"
+        terms = self._compiled_terms
+        n_rows = self._get_tbl_stats(terms['from_tbl'])[0]
+        cost = n_rows
+        n_rows_before_last_join = n_rows
+        for parent, child, join_type in terms['joins']:
+            n_rows_before_last_join = n_rows
+            n_rows *= self._get_join_rows(parent, child, join_type)/max(self._get_tbl_stats(parent)[0], 1)
+            cost += self._get_tbl_stats(child)[0]+n_rows
+        n_fltr_rows = n_rows
+        if 'where_terms' in terms:
+            fltr_sel = self._estimate_where_sel(terms['where_terms'], terms['logic_ops'])
+            n_fltr_rows = n_rows*fltr_sel
+            if terms.get('fltr_type') == 'AND' and terms['joins'][-1][2] == 'LEFT JOIN':  # the filter only drops the matches of the last child, not the rows before the join
+                n_fltr_rows = max(n_fltr_rows, n_rows_before_last_join)
+        if 'groupby_lst' in terms:  # the expected number of distinct groups among the filtered rows
+            n_grps = 1
+            for var in terms['groupby_lst']:
+                tbl_name, var_name = var.split('.') if '.' in var else (terms['from_tbl'], var)
+                n_grps *= len(self._get_col_stats(tbl_name, var_name)[0])
+            return {'n_rows': n_grps*-np.expm1(-n_fltr_rows/n_grps), 'n_fltr_rows': n_fltr_rows, 'cost': cost+n_fltr_rows}
+        return {'n_rows': n_fltr_rows, 'n_fltr_rows': n_fltr_rows, 'cost': cost}
+
+    def last_expr_terms(self) -> dict:
+        """ Returns the structured terms of the last compiled query expression, which are also the terms used by estimate_last_expr.
+
+        Returns:
+            A dictionary with the table following FROM ('from_tbl'), the list of (parent, child, join type) of the joined tables in the order of joining ('joins'), the dictionary of the joining keys of each joined child as per the parent_details of the metadata ('join_keys') and, if the expression has a WHERE clause, the list of its terms ('where_terms') along with the logical operators between them ('logic_ops'). Each WHERE term is a dictionary of the table name ('tbl_name'), the variable name ('var_name'), the operator ('op'), the list of the literal values ('vals'), whether the term is negated by NOT ('is_not') and the number of distinct values of the variable ('n_distinct'). Aggregate expressions add the list of the GROUP BY variables ('groupby_lst').
+
+        """
+        assert len(self._compiled_terms) != 0, "No query expression has been compiled yet!"
+        terms = copy.deepcopy(self._compiled_terms)
+        terms['join_keys'] = {child: list(self._metadata_lst[self._get_tbl_index(child)]['parent_details'][parent][1]) for parent, child, _ in terms['joins']}
+        for where_term in terms.get('where_terms', []):
+            where_term['n_distinct'] = len(self._get_col_stats(where_term['tbl_name'], where_term['var_name'])[0])
+        return terms
+
+    def _resample_expr(self, compile_fn) -> tuple:
+        # Compiles expressions using compile_fn until the estimates of one fall within est_rows_window and est_max_cost, which is then returned. The last expression is returned if none does within est_max_resamples trials.
+        if self.est_rows_window is None and self.est_max_cost is None:
+            return compile_fn()
+        min_rows, max_rows = self.est_rows_window if self.est_rows_window is not None else (0, np.inf)
+        max_cost = self.est_max_cost if self.est_max_cost is not None else np.inf
+        for _ in range(self.est_max_resamples):
+            compiled = compile_fn()
+            est = self.estimate_last_expr()
+            if min_rows <= est['n_rows'] <= max_rows and est['cost'] <= max_cost:
+                return compiled
+        print(f'No expression was estimated within the target window in {self.est_max_resamples} trials! I am using the last one.')
+        return compiled
+
+    def _get_tbl_stats(self, tbl_name: str) -> tuple:
+        # Returns the number of rows of the input table and a dictionary of the number of non-missing values of each variable, which are counted in the database by a single scan of the table
+        if tbl_name not in self._tbl_stats_dict:
+            var_names = [var_tpl[1] for var_tpl in self._get_tbl_var_tpl_lst(tbl_name)]
+            not_missing_counts = ', '.join(f"COUNT(NULLIF({var_name}, ''))" for var_name in var_names)
+            counts = self._get_conn().execute(f"SELECT COUNT(*), {not_missing_counts} FROM {tbl_name}").fetchone()
+            self._tbl_stats_dict[tbl_name] = (counts[0], dict(zip(var_names, counts[1:])))
+        return self._tbl_stats_dict[tbl_name]
+
+    def _get_col_stats(self, tbl_name: str, var_name: str) -> tuple:
+        # Returns the sorted distinct values of the value bag of the input variable, their cumulative relative frequencies (starting at 0) and the fraction of the rows of the table where the variable is not missing
+        if (tbl_name, var_name) not in self._col_stats_dict:
+            val_bag = self._get_val_bag(tbl_name, var_name)
+            if isinstance(val_bag, pd.Series):
+                val_bag = val_bag.sort_index()
+                vals, freqs = val_bag.index.to_numpy(), val_bag.to_numpy(dtype=np.float64)
+            else:
+                vals, freqs = np.unique(val_bag, return_counts=True)
+            cum_probs = np.concatenate([[0], np.cumsum(freqs)/freqs.sum()])
+            n_rows, n_vals_dict = self._get_tbl_stats(tbl_name)
+            self._col_stats_dict[(tbl_name, var_name)] = (vals, cum_probs, n_vals_dict[var_name]/max(n_rows, 1))
+        return self._col_stats_dict[(tbl_name, var_name)]
+
+    def _estimate_where_sel(self, where_terms: list, logic_ops: list) -> float:
+        # Returns the estimated fraction of the rows satisfying the WHERE terms, where AND binds tighter than OR (as in SQL) and the terms are assumed to be independent
+        or_grps = [[]]
+        for i, where_term in enumerate(where_terms):
+            if i > 0 and logic_ops[i-1] == 'OR':
+                or_grps.append([])
+            or_grps[-1].append(self._estimate_term_sel(where_term))
+        return 1-np.prod([1-np.prod(and_sels) for and_sels in or_grps])
+
+    def _estimate_term_sel(self, where_term: dict) -> float:
+        # Returns the estimated fraction of the rows satisfying the input WHERE term. Rows with missing values never satisfy a term, with or without NOT.
+        vals, cum_probs, not_missing_frac = self._get_col_stats(where_term['tbl_name'], where_term['var_name'])
+
+        def calc_eq(val):
+            i = np.searchsorted(vals, val, side='left')
+            return cum_probs[i+1]-cum_probs[i] if i < len(vals) and vals[i] == val else 0
+
+        def calc_lt(val, side):  # side='right' for <=
+            return cum_probs[np.searchsorted(vals, val, side=side)]
+
+        op, term_vals = where_term['op'].replace('NOT ', ''), where_term['vals']
+        if op in ('=', '<>', 'LIKE'):  # the literals of LIKE never include wildcards
+            sel = calc_eq(term_vals[0])
+        elif op == 'IN':
+            sel = sum(calc_eq(val) for val in term_vals)
+        elif op == '<' or op == '>=':
+            sel = calc_lt(term_vals[0], 'left')
+        elif op == '<=' or op == '>':
+            sel = calc_lt(term_vals[0], 'right')
+        elif op == 'BETWEEN':
+            sel = calc_lt(term_vals[1], 'right')-calc_lt(term_vals[0], 'left')
+        else:
+            raise Exception(f"Operation {op} is not recognized!")
+        if where_term['op'] in ('<>', '>=', '>') or where_term['op'].startswith('NOT '):
+            sel = 1-sel
+        if where_term['is_not']:
+            sel = 1-sel
+        return not_missing_frac*min(max(sel, 0), 1)
+
+    def _get_join_rows(self, parent: str, child: str, join_type: str) -> int:
+        # Returns the number of rows of the input parent table joined to its child table, which is counted in the database once per pair of tables and join type
+        if (parent, child, join_type) not in self._join_rows_dict:
+            self._join_rows_dict[(parent, child, join_type)] = self._get_conn().execute(f"SELECT COUNT(*) FROM {parent} {join_type} {child} {self._get_join_on_sub_expr(parent, child)}").fetchone()[0]
+        return self._join_rows_dict[(parent, child, join_type)]
+
 
 ############################################ Matching records and calculating metrics for Aggregate and Aggregate-Filter queries 
 
@@ -1242,44 +1889,34 @@ class RandomQuery():
     def _match_queries4agg(self, rnd_query: dict) -> dict:
         assert 'single' not in rnd_query['query_desc']['type'], "This method does not apply to single random queries!"
         assert '_fltr' not in rnd_query['query_desc']['type'], "This method does not apply to filter random queries. It only applies to aggregate queries!"
+        # The real and synthetic groups are aligned in a single step by factorizing their group-by keys jointly. Groups that exist in one query only are added to the other with zero count and aggregate, and both queries are returned in the sorted order of the keys.
+        if rnd_query['query_desc'].get('is_matched', False):  # already matched by the database (see twin_single_pass)
+            return rnd_query
         matched_rnd_query = {}
         ext_real = rnd_query['query_real']
         ext_syn = rnd_query['query_syn']
-
-        # redefine var names into number to assure smooth sorting
         ext_var_names = list(ext_real.columns)
-        ext_var_nmbrs = list(range(ext_real.shape[1]))
-
-        ext_real.columns = ext_var_nmbrs
-        ext_syn.columns = ext_var_nmbrs
-
         i = 2 if rnd_query['query_desc']['agg_fntn'][0] != 'None' else 1
-        red_real = ext_real.iloc[:, :-i]  # drop count and agg fntn columns
-        red_syn = ext_syn.iloc[:, :-i]
-        agg_col_names = ext_var_names[-i:]
-        agg_col_nmbrs = ext_var_nmbrs[-i:]
-        red_real.columns = ext_var_nmbrs[0:-i]
-        red_syn.columns = ext_var_nmbrs[0:-i]
-
-        assert (red_real.columns == red_syn.columns).all(
-        ), "Real and synthetic queries can not be matched since they have different variable names"
-
-        in_real_only = red_real.merge(red_syn, how='outer', indicator=True).loc[lambda x: x['_merge'] == 'left_only']
-        del in_real_only['_merge']
-        in_real_only[agg_col_nmbrs] = 0
-        ext_syn = pd.concat([ext_syn, in_real_only], axis=0, ignore_index=True)
-        ext_syn.sort_values(
-            ext_var_nmbrs[0:-i], inplace=True, ignore_index=True)
-
-        in_syn_only = red_real.merge(red_syn, how='outer', indicator=True).loc[lambda x: x['_merge'] == 'right_only']
-        del in_syn_only['_merge']
-        in_syn_only[agg_col_nmbrs] = 0
-        ext_real = pd.concat([ext_real, in_syn_only],
-                             axis=0, ignore_index=True)
-        ext_real.sort_values(
-            ext_var_nmbrs[0:-i], inplace=True, ignore_index=True)
-
-        assert len(ext_real) == len(ext_syn)
+        assert list(ext_real.columns[:-i]) == list(ext_syn.columns[:-i]), "Real and synthetic queries can not be matched since they have different variable names"
+
+        n_real = len(ext_real)
+        keys = pd.concat([ext_real.iloc[:, :-i], ext_syn.iloc[:, :-i]], axis=0, ignore_index=True)  # drop count and agg fntn columns
+        keys.columns = list(range(keys.shape[1]))  # the group-by variable names may be repeated across the joined tables
+        grp_ids = keys.groupby(list(keys.columns), sort=True, dropna=False).ngroup().values  # ids follow the sorted order of the keys
+        n_grps = grp_ids.max()+1 if len(grp_ids) != 0 else 0
+        first_idx = np.empty(n_grps, dtype=np.int64)
+        first_idx[grp_ids[::-1]] = np.arange(len(grp_ids))[::-1]  # the first row of each group
+        grp_keys = keys.iloc[first_idx].reset_index(drop=True)
+
+        aligned_real, aligned_syn = {}, {}
+        for k in range(i, 0, -1):  # count and agg fntn columns from the back
+            real_vals, syn_vals = ext_real.iloc[:, -k].values, ext_syn.iloc[:, -k].values
+            aligned_real[k] = np.zeros(n_grps, dtype=np.result_type(real_vals.dtype, syn_vals.dtype))
+            aligned_syn[k] = aligned_real[k].copy()
+            aligned_real[k][grp_ids[:n_real]] = real_vals
+            aligned_syn[k][grp_ids[n_real:]] = syn_vals
+        ext_real = pd.concat([grp_keys, pd.DataFrame(aligned_real)], axis=1)
+        ext_syn = pd.concat([grp_keys, pd.DataFrame(aligned_syn)], axis=1)
         ext_real.columns = ext_var_names
         ext_syn.columns = ext_var_names
 
@@ -1378,6 +2015,28 @@ class RandomQuery():
             return hlngr_dist, pivot
         
         
+    def _calc_hlngr4cat_counts(self, real_counts: pd.Series, syn_counts: pd.Series):
+        # Same as _calc_hlngr4cat but from the category counts of the real and synthetic variables (see _make_pushdown_query) instead of their values.
+        real_var_obsvs = real_counts.sum()
+        syn_var_obsvs = syn_counts.sum()
+        if real_var_obsvs==0 and syn_var_obsvs==0:
+            return np.nan, np.nan
+        else:
+            real_probs = real_counts/real_var_obsvs if real_var_obsvs!=0 else real_counts.astype(float)
+            if 'NaN' not in real_probs.index:
+                real_probs.loc['NaN'] = 0
+            real_probs.rename(f'real_{real_counts.name}', inplace=True)
+            syn_probs = syn_counts/syn_var_obsvs if syn_var_obsvs!=0 else syn_counts.astype(float)
+            if 'NaN' not in syn_probs.index:
+                syn_probs.loc['NaN'] = 0
+            syn_probs.rename(f'syn_{syn_counts.name}', inplace=True)
+            pivot=pd.concat([real_probs,syn_probs],axis=1, join='outer')
+            pivot.fillna(0, inplace=True)
+            p=pivot.iloc[:,0].values
+            q=pivot.iloc[:,1].values
+            hlngr_dist = np.sqrt(np.sum((np.sqrt(p)-np.sqrt(q))**2)/2)
+            return hlngr_dist, pivot
+
     def _calc_hlngr4cnt(self,real_var: pd.Series, syn_var: pd.Series):
 
         if len(real_var)==0 and len(syn_var)==0: #If both real and synthetic queries returned NO records, then Hellinger distance can not be calculated
@@ -1396,16 +2055,48 @@ class RandomQuery():
                 hlngr_dist, pivot=self._calc_hlngr4cat(real_var,syn_var)
                 return hlngr_dist, pivot
              
-            p = gaussian_kde(real_X) # estimated density function for real data using gaussian kernel
-            q = gaussian_kde(syn_X)# estimated density function for syn data using gaussian kernel
-            hlngr_integrand= lambda z: (p(z)**0.5 - q(z)**0.5)**2
             lb=min(min(real_X),min(syn_X))
             ub=max(max(real_X),max(syn_X))
-            # hlngr_dist = np.sqrt(quad(hlngr_integrand, -np.inf, np.inf)[0]/2)
-            hlngr_dist = np.sqrt(quad(hlngr_integrand, lb, ub)[0]/2)
-            
-            pdfs = (p, q)  # density functions
+            if self.hlngr_cnt_method == 'grid':
+                grid = np.linspace(lb, ub, self.hlngr_grid_size)
+                p = self._calc_grid_kde(real_X, grid) # estimated density for real data on the grid using gaussian kernel
+                q = self._calc_grid_kde(syn_X, grid)
+                hlngr_dist = np.sqrt(trapezoid((np.sqrt(p)-np.sqrt(q))**2, grid)/2)
+                pdfs = (grid, p, q)  # densities on the grid
+            elif self.hlngr_cnt_method == 'hist':
+                pooled_X = np.concatenate([real_X, syn_X]).astype(np.float64)
+                bin_width = 2*np.subtract(*np.percentile(pooled_X, [75, 25]))*len(pooled_X)**(-1/3)  # Freedman-Diaconis width of the pooled values
+                n_bins = min(int(np.ceil((ub-lb)/bin_width)), self.hlngr_grid_size) if bin_width > 0 else 1  # capped before any edges are built (e.g. for outliers)
+                bin_edges = np.histogram_bin_edges(pooled_X, bins=max(n_bins, 1), range=(lb, ub))
+                p = np.histogram(real_X, bin_edges)[0]/len(real_X)
+                q = np.histogram(syn_X, bin_edges)[0]/len(syn_X)
+                hlngr_dist = np.sqrt(np.sum((np.sqrt(p)-np.sqrt(q))**2)/2)
+                pdfs = (bin_edges, p, q)  # probabilities of the shared bins
+            elif self.hlngr_cnt_method == 'kde_quad':
+                p = gaussian_kde(real_X) # estimated density function for real data using gaussian kernel
+                q = gaussian_kde(syn_X)# estimated density function for syn data using gaussian kernel
+                hlngr_integrand= lambda z: (p(z)**0.5 - q(z)**0.5)**2
+                # hlngr_dist = np.sqrt(quad(hlngr_integrand, -np.inf, np.inf)[0]/2)
+                hlngr_dist = np.sqrt(quad(hlngr_integrand, lb, ub)[0]/2)
+                pdfs = (p, q)  # density functions
+            else:
+                raise ValueError("Please choose either 'grid', 'hist' or 'kde_quad' for hlngr_cnt_method")
             return hlngr_dist, pdfs
+
+    def _calc_grid_kde(self, X: np.ndarray, grid: np.ndarray) -> np.ndarray:
+        # Evaluates the Gaussian kernel density estimate of X on the input equally spaced grid. X is linearly binned onto the grid and convolved with the kernel using FFT. The bandwidth follows Scott's rule as in scipy's gaussian_kde.
+        X = X.astype(np.float64)
+        n_grid, dx = len(grid), grid[1]-grid[0]
+        bandwidth = len(X)**(-1/5)*np.std(X, ddof=1)
+        pos = (X-grid[0])/dx
+        lower_idx = np.clip(np.floor(pos).astype(np.int64), 0, n_grid-2)
+        upper_weight = pos-lower_idx
+        counts = np.bincount(lower_idx, weights=1-upper_weight, minlength=n_grid) + \
+            np.bincount(lower_idx+1, weights=upper_weight, minlength=n_grid)
+        offsets = np.arange(-(n_grid-1), n_grid)*dx
+        kernel = np.exp(-0.5*(offsets/bandwidth)**2)/(bandwidth*np.sqrt(2*np.pi))
+        density = fftconvolve(counts, kernel, mode='valid')/len(X)
+        return np.clip(density, 0, None)  # FFT round-off may produce tiny negative values
         
     def _calc_hlngr4fltr(self,var_type,real_var: pd.Series, syn_var: pd.Series):
         if var_type in ('UNQID', 'KEY') or isinstance(real_var,pd.DataFrame): #the second condition detetcs if teh var name is repeated twice (ie datframe instead of series) in the query which means that it is a join varibale even if it is decalred in the metdata otherwise, so it will excluded
@@ -1417,13 +2108,43 @@ class RandomQuery():
         else:
             raise TypeError(f'Unrecognized variable type: {var_type}')
         return var_hlngr_dist,var_pivot
+
+    def _calc_var_hlngr4fltr(self, rnd_query: dict, real: pd.DataFrame, syn: pd.DataFrame, real_table_name: str, var: str, var_type: str):
+        # Calculates the Hellinger distance of a variable of the filter query. If the query was made in pushdown mode, the CAT variables are scored from their category counts while the variables that were not fetched (i.e. repeated names) are not scored.
+        if 'cat_counts_real' not in rnd_query:
+            return self._calc_hlngr4fltr(var_type, real[var], syn[var])
+        elif (real_table_name, var) in rnd_query['cat_counts_real']:
+            return self._calc_hlngr4cat_counts(rnd_query['cat_counts_real'][(real_table_name, var)], rnd_query['cat_counts_syn'][(real_table_name, var)])
+        elif var in real.columns:
+            return self._calc_hlngr4fltr(var_type, real[var], syn[var])
+        else:
+            return np.nan, np.nan
         
         
+    def _sample_rows4hlngr(self, query_res: pd.DataFrame, rng: np.random.Generator) -> pd.DataFrame:
+        # Returns a uniform random sample (without replacement) of hlngr_sample_size rows from the query results, or the results themselves if they are not larger than that.
+        if len(query_res) <= self.hlngr_sample_size:
+            return query_res
+        sample_idx = np.sort(rng.choice(len(query_res), size=self.hlngr_sample_size, replace=False))
+        return query_res.iloc[sample_idx]
+
+    def _calc_hlngr_ci(self, var_type, var_hlngr_dist: float, real_var: pd.Series, syn_var: pd.Series, rng: np.random.Generator):
+        # Calculates the normal confidence interval of the Hellinger distance of a variable around its estimate from the (sampled) real and synthetic values, using the bootstrap standard error. The percentile interval is avoided since resampling inflates the Hellinger distance and would shift the interval away from the estimate.
+        boot_dists = []
+        for _ in range(self.hlngr_n_bootstraps):
+            real_idx = rng.integers(0, len(real_var), size=len(real_var))
+            syn_idx = rng.integers(0, len(syn_var), size=len(syn_var))
+            boot_dist, _ = self._calc_hlngr4fltr(var_type, real_var.iloc[real_idx], syn_var.iloc[syn_idx])
+            boot_dists.append(boot_dist)
+        margin = stats.norm.ppf(1-(1-self.hlngr_ci_level)/2)*np.nanstd(boot_dists, ddof=1)
+        return max(var_hlngr_dist-margin, 0), min(var_hlngr_dist+margin, 1)
+
     def gather_metrics4fltr(self, rnd_query: dict):
         real = rnd_query['query_real']
         syn = rnd_query['query_syn']
         desc = rnd_query['query_desc']
         scored_query=rnd_query
+        is_sampled = max(len(real), len(syn)) < max(desc['n_rows_real'], desc['n_rows_syn'])  # the distances are estimated from row samples of the results (see hlngr_sample_size)
         hlngr_vars={} #catcher for the individual hellinger distance pertaining to each variable in rnd_query (or the tabular dataset)
         hlngr_vars['real_table_name']=[]
         hlngr_vars['syn_table_name']=[]
@@ -1432,14 +2153,15 @@ class RandomQuery():
         hlngr_vars['var_hlngr_distance']=[]
         hlngr_pivots=[]
         if len(desc['join_tbl_name_lst_real'])==0: #sole table
-            for var in real.columns:
+            sole_vars = [var_tpl[1] for var_tpl in self._get_tbl_var_tpl_lst(desc['from_tbl_name_real'])] if 'cat_counts_real' in rnd_query else real.columns  # in pushdown mode, the CAT variables are not in the results
+            for var in sole_vars:
                 real_table_name=desc['from_tbl_name_real']
                 hlngr_vars['real_table_name'].append(real_table_name)
                 hlngr_vars['syn_table_name'].append(desc['from_tbl_name_syn'])
                 hlngr_vars['var_name'].append(var)
                 var_type=self._get_var_type(real_table_name,var) #check type each variable
                 hlngr_vars['var_type'].append(var_type)
-                var_hlngr_dist, var_pivot=self. _calc_hlngr4fltr(var_type, real[var],syn[var])
+                var_hlngr_dist, var_pivot=self._calc_var_hlngr4fltr(rnd_query, real, syn, real_table_name, var, var_type)
                 hlngr_vars['var_hlngr_distance'].append(var_hlngr_dist)
                 hlngr_pivots.append(var_pivot) #pivot represent the ditributio or histogram for each variable and can be used in the future
         else: #longitudina 
@@ -1454,7 +2176,7 @@ class RandomQuery():
                 hlngr_vars['var_name'].append(var)
                 var_type=self._get_var_type(from_real_table,var) #check type each variable
                 hlngr_vars['var_type'].append(var_type)
-                var_hlngr_dist, _=self. _calc_hlngr4fltr(var_type, real[var],syn[var]) #The pivot (ie var distribution or histogram is ignored for longitudinal since it will get complicated, however it can be retrieved whenver needed)
+                var_hlngr_dist, _=self._calc_var_hlngr4fltr(rnd_query, real, syn, from_real_table, var, var_type) #The pivot (ie var distribution or histogram is ignored for longitudinal since it will get complicated, however it can be retrieved whenver needed)
                 hlngr_vars['var_hlngr_distance'].append(var_hlngr_dist)         
             hlngr_vars=pd.DataFrame(hlngr_vars)  #The hellinger df for the 'from' tables
             
@@ -1476,22 +2198,39 @@ class RandomQuery():
                     hlngr_vars4join['var_name'].append(var)
                     var_type=self._get_var_type(this_real_table,var) #check type of each variable
                     hlngr_vars4join['var_type'].append(var_type)
-                    var_hlngr_dist, _=self. _calc_hlngr4fltr(var_type, real[var],syn[var]) #The pivot (ie var distribution or histogram is ignored for longitudinal since it will get complicated, however it can be retrieved whenver needed)
+                    var_hlngr_dist, _=self._calc_var_hlngr4fltr(rnd_query, real, syn, this_real_table, var, var_type) #The pivot (ie var distribution or histogram is ignored for longitudinal since it will get complicated, however it can be retrieved whenver needed)
                     hlngr_vars4join['var_hlngr_distance'].append(var_hlngr_dist)         
             hlngr_vars4join=pd.DataFrame(hlngr_vars4join)  #The hellinger df for the 'from' tables
             
             hlngr_vars=pd.concat([hlngr_vars,hlngr_vars4join], axis=0, ignore_index=True)        #vertically stack both dataframes above 
              
         #calc median dataframe and otehr stats
-        data_hlngr_median = np.median(list(hlngr_vars['var_hlngr_distance'])) #this will ignore any np.nan by default
-        data_hlngr_stddev = np.std(list(hlngr_vars['var_hlngr_distance'])) 
-        data_iqr = np.subtract(*np.percentile(list(hlngr_vars['var_hlngr_distance']), [75, 25]))
+        var_hlngr_dists = np.array(hlngr_vars['var_hlngr_distance'], dtype=np.float64)
+        if np.isnan(var_hlngr_dists).all():  # e.g. both queries returned no records
+            data_hlngr_median, data_hlngr_stddev, data_iqr = np.nan, np.nan, np.nan
+        else:  # the variables that are not scored (e.g. the join keys) are ignored
+            data_hlngr_median = np.nanmedian(var_hlngr_dists)
+            data_hlngr_stddev = np.nanstd(var_hlngr_dists)
+            data_iqr = np.subtract(*np.nanpercentile(var_hlngr_dists, [75, 25]))
         
         scored_query['hlngr_median']=data_hlngr_median
         scored_query['hlngr_iqr']=data_iqr
         scored_query['hlngr_stddev']=data_hlngr_stddev
         
         hlngr_vars=pd.DataFrame(hlngr_vars)
+        if is_sampled:  # attach the confidence interval of each estimated distance
+            hlngr_rng = self._spawn_rng()
+            ci_lst = []
+            for var, var_type, var_hlngr_dist in zip(hlngr_vars['var_name'], hlngr_vars['var_type'], hlngr_vars['var_hlngr_distance']):
+                if np.isnan(var_hlngr_dist):
+                    ci_lst.append((np.nan, np.nan))
+                elif var not in real.columns:  # counted exactly in the database (pushdown)
+                    ci_lst.append((var_hlngr_dist, var_hlngr_dist))
+                else:
+                    ci_lst.append(self._calc_hlngr_ci(var_type, var_hlngr_dist, real[var], syn[var], hlngr_rng))
+            hlngr_vars['var_hlngr_ci_lower'] = [ci[0] for ci in ci_lst]
+            hlngr_vars['var_hlngr_ci_upper'] = [ci[1] for ci in ci_lst]
+        scored_query['hlngr_sampled'] = is_sampled
         scored_query['hlngr_breakdown']=hlngr_vars  #hlngr_vars is dataframe showin each variable and its corresponding hellinger distance  
         
         return scored_query  #scored query will include entries for the median, IQR and stddev of Hellinger distances of all varibales. The last entry is a dataframe  of hlmngr breakdown  per variable
@@ -1504,11 +2243,19 @@ class RandomQuery():
 ############################################ Calculating metrics for TABULAR datasets
 
     def gather_metrics4tabular(self, real_table_name, syn_table_name):
-        conn=sqlite3.connect(self._db_path)
-        with conn:
-            real= pd.read_sql_query(f'SELECT * FROM {real_table_name}', conn)                    
-            syn = pd.read_sql_query(f'SELECT * FROM {syn_table_name}', conn)
-        assert real.shape == syn.shape, f"The synesthetic table {syn_table_name} does not have the same shape of the real table {real_table_name}!"
+        conn=self._get_conn()
+        if self.hlngr_pushdown: # only the non-CAT variables are read along with the category counts
+            (real_shape, var_names), (syn_shape, _) = self._get_tbl_shape(conn, real_table_name), self._get_tbl_shape(conn, syn_table_name)
+            assert real_shape == syn_shape, f"The synesthetic table {syn_table_name} does not have the same shape of the real table {real_table_name}!"
+            var_types = [self._get_var_type(real_table_name, var) for var in var_names]
+            real, real_counts = self._make_pushdown_query(f' FROM {real_table_name}', [(real_table_name, var) for var in var_names], var_types, lambda expr: expr)
+            syn, syn_counts = self._make_pushdown_query(f' FROM {syn_table_name}', [(syn_table_name, var) for var in var_names], var_types, lambda expr: expr)
+        else:
+            with conn:
+                real= pd.read_sql_query(f'SELECT * FROM {real_table_name}', conn)                    
+                syn = pd.read_sql_query(f'SELECT * FROM {syn_table_name}', conn)
+            assert real.shape == syn.shape, f"The synesthetic table {syn_table_name} does not have the same shape of the real table {real_table_name}!"
+            var_names = real.columns
         #desc = rnd_query['query_desc']
         #scored_query=rnd_query
         hlngr_vars={} #catcher for the individual hellinger distance pertaining to each variable in rnd_query (or the tabular dataset)
@@ -1518,13 +2265,17 @@ class RandomQuery():
         hlngr_vars['var_type']=[]
         hlngr_vars['var_hlngr_distance']=[]
         hlngr_pivots=[]
-        for var in real.columns:
+        for var in var_names:
             hlngr_vars['real_table_name'].append(real_table_name)
             hlngr_vars['syn_table_name'].append(syn_table_name)
             hlngr_vars['var_name'].append(var)
             var_type=self._get_var_type(real_table_name,var) #check type each variable
             hlngr_vars['var_type'].append(var_type)
-            if var_type=='CAT':
+            if var_type=='CAT' and self.hlngr_pushdown:
+                var_hlngr_dist, var_pivot=self._calc_hlngr4cat_counts(real_counts[(real_table_name, var)], syn_counts[(syn_table_name, var)])
+                hlngr_vars['var_hlngr_distance'].append(var_hlngr_dist)
+                hlngr_pivots.append(var_pivot)
+            elif var_type=='CAT':
                 var_hlngr_dist, var_pivot=self._calc_hlngr4cat(real[var],syn[var])
                 hlngr_vars['var_hlngr_distance'].append(var_hlngr_dist)
                 hlngr_pivots.append(var_pivot)
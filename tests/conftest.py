@@ -0,0 +1,49 @@
+import sys
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]/'src'))
+
+
+TBL_METADATA = {'table_name': 'treal', 'table_vars': [['a', 'categorical'], ['b', 'categorical'], ['c', 'continuous'], ['d', 'continuous']]}
+PARENT_METADATA = {'table_name': 'preal', 'table_vars': [['pid', 'key'], ['sex', 'categorical'], ['age', 'continuous']]}
+CHILD_METADATA = {'table_name': 'creal', 'table_vars': [['cid', 'categorical'], ['pid', 'key'], ['drug', 'categorical'], ['dose', 'continuous']],
+                  'parent_details': {'preal': [['pid'], ['pid']]}}
+
+
+def _make_tbl(n_rows, seed):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'a': rng.choice(['x', 'y', 'z'], n_rows), 'b': rng.choice(['1', '2', '3'], n_rows),
+                         'c': rng.normal(50, 10, n_rows).round(2), 'd': rng.integers(0, 100, n_rows).astype(float)})
+
+
+def _make_parent(n_rows, seed):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'pid': [str(i) for i in range(n_rows)], 'sex': rng.choice(['M', 'F'], n_rows), 'age': rng.integers(20, 90, n_rows).astype(float)})
+
+
+def _make_child(n_rows, n_parents, seed):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'cid': [str(i) for i in range(n_rows)], 'pid': rng.integers(0, n_parents, n_rows).astype(str),
+                         'drug': rng.choice(['A', 'B', 'C'], n_rows), 'dose': rng.normal(5, 1, n_rows).round(3)})
+
+
+@pytest.fixture(scope='session')
+def db_path(tmp_path_factory):
+    # A database of a tabular dataset (treal, tsyn) and of a longitudinal dataset with two synthetic candidates (preal/creal, psyn/csyn and psyn2/csyn2)
+    path = str(tmp_path_factory.mktemp('db')/'test.db')
+    conn = sqlite3.connect(path)
+    _make_tbl(500, 1).to_sql('treal', conn, index=False)
+    _make_tbl(500, 2).to_sql('tsyn', conn, index=False)
+    _make_parent(100, 3).to_sql('preal', conn, index=False)
+    _make_child(400, 100, 4).to_sql('creal', conn, index=False)
+    for i, syn_suffix in enumerate(['syn', 'syn2']):
+        _make_parent(100, 5+2*i).to_sql(f'p{syn_suffix}', conn, index=False)
+        _make_child(400, 100, 6+2*i).to_sql(f'c{syn_suffix}', conn, index=False)
+    conn.commit()
+    conn.close()
+    return path
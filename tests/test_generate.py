@@ -0,0 +1,83 @@
+import time
+
+import numpy as np
+import pytest
+
+from conftest import PARENT_METADATA, CHILD_METADATA
+from fuzzy_sql.randomquery import RandomQuery
+from fuzzy_sql.generate import gen_fltr_queries, gen_fltr_score_matrix, gen_aggfltr_score_matrix
+
+
+SYN_TBL_LSTS = [['psyn', 'csyn'], ['psyn2', 'csyn2'], ['preal', 'creal']]
+
+
+def test_fltr_score_matrix_is_finite(db_path):
+    score_matrix = gen_fltr_score_matrix(4, db_path, ['preal', 'creal'], [PARENT_METADATA, CHILD_METADATA], SYN_TBL_LSTS, seed=2)
+    assert score_matrix.shape == (4, len(SYN_TBL_LSTS))
+    assert np.isfinite(score_matrix.values.astype(float)).all()
+    assert (score_matrix['preal, creal'] == 0).all()  # the real tables against themselves
+
+
+def test_aggfltr_score_matrix_is_finite(db_path):
+    query_obj = RandomQuery(db_path, ['preal', 'creal'], [PARENT_METADATA, CHILD_METADATA])
+    query_obj.est_rows_window = (1, np.inf)  # an aggregate query returning no groups on either side is not scored
+    score_matrix = gen_aggfltr_score_matrix(4, db_path, ['preal', 'creal'], [PARENT_METADATA, CHILD_METADATA], SYN_TBL_LSTS, query_obj=query_obj, seed=2)
+    query_obj.close()
+    assert score_matrix.shape == (4, len(SYN_TBL_LSTS))
+    assert np.isfinite(score_matrix.values.astype(float)).all()
+
+
+def test_pushdown_fltr_score_matrix_matches(db_path):
+    score_matrices = []
+    for hlngr_pushdown in [False, True]:
+        query_obj = RandomQuery(db_path, ['preal', 'creal'], [PARENT_METADATA, CHILD_METADATA])
+        query_obj.hlngr_pushdown = hlngr_pushdown
+        score_matrices.append(gen_fltr_score_matrix(4, db_path, ['preal', 'creal'], [PARENT_METADATA, CHILD_METADATA], SYN_TBL_LSTS, query_obj=query_obj, seed=2))
+        query_obj.close()
+    assert np.allclose(score_matrices[0].values.astype(float), score_matrices[1].values.astype(float))
+
+
+def test_sampled_fltr_query_keeps_compile_stream(db_path):
+    query_obj = RandomQuery(db_path, ['preal', 'creal'], [PARENT_METADATA, CHILD_METADATA])
+    query_obj.fetch_chunk_size = 7  # the reservoir is updated over many chunks
+    query_obj.est_rows_window = (20, np.inf)
+    exprs = []
+    for hlngr_sample_size in [None, 10]:
+        query_obj.hlngr_sample_size = hlngr_sample_size
+        query_obj.reseed(2)
+        real_expr, real_from_tbl, real_join_tbl_lst = query_obj.compile_fltr_expr()
+        rnd_query = query_obj.make_twin_fltr_query(['psyn', 'csyn'], real_expr, real_from_tbl, real_join_tbl_lst)
+        scored_query = query_obj.gather_metrics4fltr(rnd_query)
+        exprs.append((real_expr, query_obj.compile_fltr_expr()[0]))
+        n_rows = rnd_query['query_desc']['n_rows_real']
+        assert len(rnd_query['query_real']) == (n_rows if hlngr_sample_size is None else min(n_rows, hlngr_sample_size))
+        assert scored_query['hlngr_sampled'] == (hlngr_sample_size is not None and max(n_rows, rnd_query['query_desc']['n_rows_syn']) > hlngr_sample_size)
+    query_obj.close()
+    assert exprs[0] == exprs[1]  # sampling the results does not consume the generator of the compiled queries
+
+
+def test_fix_seed_queries_do_not_depend_on_n_workers(db_path):
+    sql_lsts = []
+    for n_workers in [1, 3]:
+        query_obj = RandomQuery(db_path, ['preal', 'creal'], [PARENT_METADATA, CHILD_METADATA])
+        query_obj.fix_seed = True
+        scored_queries = gen_fltr_queries(6, db_path, ['preal', 'creal'], [PARENT_METADATA, CHILD_METADATA], ['psyn', 'csyn'], query_obj=query_obj, metrics_only=True, n_workers=n_workers)
+        query_obj.close()
+        sql_lsts.append([scored_query['query_desc']['sql_real'] for scored_query in scored_queries])
+    assert sql_lsts[0] == sql_lsts[1]
+    assert len(set(sql_lsts[0])) == 6
+
+
+def test_pushdown_fltr_query_shares_one_deadline(db_path):
+    query_obj = RandomQuery(db_path, ['preal', 'creal'], [PARENT_METADATA, CHILD_METADATA])
+    query_obj.hlngr_pushdown = True
+    query_obj.progress_check_steps = 1
+    query_obj.reseed(2)
+    real_expr, real_from_tbl, real_join_tbl_lst = query_obj.compile_fltr_expr()
+    with query_obj._query_deadline(1e-9):
+        time.sleep(0.01)  # the deadline passes before any statement of the side starts
+        with pytest.raises(TimeoutError):
+            query_obj._make_pushdown_fltr_query(real_expr, real_from_tbl, real_join_tbl_lst, False, max_query_time=5)
+    query, _ = query_obj._make_pushdown_fltr_query(real_expr, real_from_tbl, real_join_tbl_lst, False, max_query_time=5)  # the deadline is cleared afterwards
+    query_obj.close()
+    assert query is not None
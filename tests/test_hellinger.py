@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import TBL_METADATA
+from fuzzy_sql.randomquery import RandomQuery
+
+
+SAMPLE_PAIRS = {
+    'shifted_normals': (lambda rng: rng.normal(0, 1, 2000), lambda rng: rng.normal(0.3, 1, 2000)),
+    'scaled_normals': (lambda rng: rng.normal(0, 1, 2000), lambda rng: rng.normal(0, 1.5, 2000)),
+    'identical_exponentials': (lambda rng: rng.exponential(1, 2000), lambda rng: rng.exponential(1, 2000)),
+}
+
+
+@pytest.fixture(scope='module')
+def query_obj(db_path):
+    query_obj = RandomQuery(db_path, ['treal'], [TBL_METADATA])
+    yield query_obj
+    query_obj.close()
+
+
+def _calc_hlngr(query_obj, method, pair_name):
+    rng = np.random.default_rng(7)
+    real_fn, syn_fn = SAMPLE_PAIRS[pair_name]
+    query_obj.hlngr_cnt_method = method
+    return query_obj._calc_hlngr4cnt(pd.Series(real_fn(rng)), pd.Series(syn_fn(rng)))[0]
+
+
+@pytest.mark.parametrize('pair_name', SAMPLE_PAIRS)
+def test_grid_matches_kde_quad(query_obj, pair_name):
+    assert _calc_hlngr(query_obj, 'grid', pair_name) == pytest.approx(_calc_hlngr(query_obj, 'kde_quad', pair_name), abs=1e-3)
+
+
+@pytest.mark.parametrize('pair_name', SAMPLE_PAIRS)
+def test_hist_is_close_to_kde_quad(query_obj, pair_name):
+    assert _calc_hlngr(query_obj, 'hist', pair_name) == pytest.approx(_calc_hlngr(query_obj, 'kde_quad', pair_name), abs=0.07)
+
+
+def test_hist_bins_are_capped_for_outliers(query_obj):
+    rng = np.random.default_rng(7)
+    query_obj.hlngr_cnt_method = 'hist'
+    real_var = pd.Series(np.append(rng.normal(0, 1, 5000), 1e9))  # a single sentinel value stretches the range
+    hlngr_dist, (bin_edges, _, _) = query_obj._calc_hlngr4cnt(real_var, pd.Series(rng.normal(0, 1, 5000)))
+    assert 0 <= hlngr_dist <= 1
+    assert len(bin_edges) <= query_obj.hlngr_grid_size+1
@@ -0,0 +1,16 @@
+from conftest import PARENT_METADATA, CHILD_METADATA
+from fuzzy_sql.randomquery import RandomQuery
+from fuzzy_sql.load import advise_indexes
+
+
+def test_advise_indexes_proposes_distinct_partial_indexes(db_path):
+    query_obj = RandomQuery(db_path, ['preal', 'creal'], [PARENT_METADATA, CHILD_METADATA])
+    query_obj.reseed(4)
+    index_df, latency_df = advise_indexes(db_path, ['preal', 'creal'], [PARENT_METADATA, CHILD_METADATA], ['psyn', 'csyn'], n_queries=30, query_obj=query_obj, apply=False)
+    query_obj.close()
+    assert len(index_df) != 0
+    n_tbl_vars = {'preal': len(PARENT_METADATA['table_vars']), 'creal': len(CHILD_METADATA['table_vars'])}
+    var_sets = [(tbl_name, frozenset(index_vars)) for tbl_name, index_vars in zip(index_df['table_name'], index_df['index_vars'])]
+    assert len(set(var_sets)) == len(var_sets)  # no permutations of the same variables
+    assert all(len(var_set) < n_tbl_vars[tbl_name] for tbl_name, var_set in var_sets)
+    assert latency_df['timeout_before_real'].dtype == bool